@@ -0,0 +1,228 @@
+'''
+ChatCompletionClient 对本地桩服务器(http.server)的测试: SSE 解析、429/5xx 重试、4xx 不重试、超时、并发上限
+
+    python benchmarks/bench_api_client.py
+'''
+import sys
+import json
+import time
+from pathlib import Path
+from threading import Lock, Thread
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+root_dir = Path(__file__).parent.parent
+sys.path.append(str(root_dir))
+
+import requests
+from model.api_client import ChatCompletionClient, ApiError
+
+
+class StubState:
+    '''
+    桩服务器的行为: 先依次返回 statuses 中的状态码, 之后正常流式返回
+    '''
+    def __init__(self):
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self, statuses=(), header_delay: float = 0.0, chunk_delay: float = 0.0):
+        with self.lock:
+            self.statuses = list(statuses)
+            self.header_delay = header_delay
+            self.chunk_delay = chunk_delay
+            self.requests = 0
+            self.in_flight = 0
+            self.max_in_flight = 0
+            self.bodies = []
+
+
+STATE = StubState()
+REASONING = ["先想", "一想"]
+CONTENT = ["你好", "喵~"]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, 流式响应使用 chunked 编码
+
+    def log_message(self, format, *args):
+        pass
+
+    def _chunk(self, data: str) -> None:
+        data = data.encode('utf-8')
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        body = b'{"data": []}'
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with STATE.lock:
+            STATE.requests += 1
+            STATE.bodies.append(body)
+            status = STATE.statuses.pop(0) if STATE.statuses else 200
+            STATE.in_flight += 1
+            STATE.max_in_flight = max(STATE.max_in_flight, STATE.in_flight)
+        try:
+            time.sleep(STATE.header_delay)
+            if status != 200:
+                error = json.dumps({"error": {"message": f"stub {status}"}}).encode('utf-8')
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(error)))
+                self.end_headers()
+                self.wfile.write(error)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")  # 不声明 charset
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for text in REASONING:
+                self._chunk(f"data: {json.dumps({'choices': [{'delta': {'reasoning_content': text}}]}, ensure_ascii=False)}\n\n")
+                time.sleep(STATE.chunk_delay)
+            for text in CONTENT:
+                self._chunk(f"data: {json.dumps({'choices': [{'delta': {'content': text}}]}, ensure_ascii=False)}\n\n")
+                time.sleep(STATE.chunk_delay)
+            self._chunk(": keep-alive comment\n\n")
+            self._chunk(f"data: {json.dumps({'choices': [], 'usage': {'completion_tokens': 42}})}\n\n")
+            self._chunk("data: [DONE]\n\n")
+            self._chunk("")
+        except (BrokenPipeError, ConnectionResetError):  # 客户端超时断开
+            pass
+        finally:
+            with STATE.lock:
+                STATE.in_flight -= 1
+
+
+def make_client(base_url: str, **kwargs) -> ChatCompletionClient:
+    config = {"api_key": "test", "model": "stub", "connect_timeout": 1, "read_timeout": 1,
+              "max_retries": 2, "backoff": 0.01, "max_concurrency": 4}
+    config.update(kwargs)
+    return ChatCompletionClient(base_url=base_url, **config)
+
+
+def check(name: str, func) -> bool:
+    end = time.time()
+    try:
+        func()
+    except AssertionError as e:
+        print(f"FAIL | {name} | {e}")
+        return False
+    print(f"ok   | {name} | {(time.time() - end) * 1000:.0f} ms")
+    return True
+
+
+MESSAGES = [{"role": "system", "content": "sys"}, {"role": "user", "content": "hi", "_tokens": (0, 1)}]
+
+
+def test_sse() -> None:
+    STATE.reset()
+    client = make_client(BASE_URL)
+    chunks = list(client.stream(MESSAGES))
+    outputs = client.chat(MESSAGES)
+    assert outputs["response"] == "<think>\n先想一想\n</think>\n\n你好喵~", outputs["response"]
+    assert "".join(chunks) == outputs["response"], chunks
+    assert outputs["token_num"] == 42, outputs
+    assert outputs["ttft"] is not None
+    assert STATE.bodies[0]["messages"][1] == {"role": "user", "content": "hi"}, "本地附加字段不应发送"
+    assert STATE.bodies[0]["stream"] is True
+
+
+def test_retry() -> None:
+    STATE.reset(statuses=[503, 429])
+    outputs = make_client(BASE_URL).chat(MESSAGES)
+    assert outputs["response"].endswith("你好喵~")
+    assert STATE.requests == 3, STATE.requests
+
+
+def test_retry_exhausted() -> None:
+    STATE.reset(statuses=[500, 502, 503, 504])
+    try:
+        make_client(BASE_URL, max_retries=2).chat(MESSAGES)
+    except ApiError:
+        pass
+    else:
+        raise AssertionError("应抛出 ApiError")
+    assert STATE.requests == 3, STATE.requests
+
+
+def test_client_error() -> None:
+    STATE.reset(statuses=[400, 401, 400])
+    client = make_client(BASE_URL, max_concurrency=1)
+    for _ in range(3):
+        try:
+            client.chat(MESSAGES)
+        except ApiError:
+            pass
+        else:
+            raise AssertionError("应抛出 ApiError")
+    assert STATE.requests == 3, f"4xx 不应重试: {STATE.requests}"
+    # 出错的响应已关闭, 连接池(大小 1)仍可继续使用
+    assert client.chat(MESSAGES)["token_num"] == 42
+
+
+def test_header_timeout() -> None:
+    STATE.reset(header_delay=0.5)
+    try:
+        make_client(BASE_URL, read_timeout=0.2, max_retries=1).chat(MESSAGES)
+    except ApiError:
+        pass
+    else:
+        raise AssertionError("应抛出 ApiError")
+    assert STATE.requests == 2, STATE.requests
+
+
+def test_chunk_timeout() -> None:
+    STATE.reset(chunk_delay=0.5)
+    try:
+        make_client(BASE_URL, read_timeout=0.2).chat(MESSAGES)
+    except (requests.ConnectionError, requests.Timeout):
+        pass
+    else:
+        raise AssertionError("数据块之间超时应抛出异常")
+    assert STATE.requests == 1, "已开始返回的流不应重试"
+
+
+def test_concurrency() -> None:
+    STATE.reset(chunk_delay=0.02)
+    client = make_client(BASE_URL, max_concurrency=3)
+    with ThreadPoolExecutor(max_workers=12) as pool:
+        results = list(pool.map(lambda _: client.chat(MESSAGES), range(24)))
+    assert all(r["token_num"] == 42 for r in results)
+    assert STATE.max_in_flight <= 3, STATE.max_in_flight
+
+
+def test_ping() -> None:
+    assert make_client(BASE_URL).ping()
+    assert not make_client("http://127.0.0.1:9", connect_timeout=0.2).ping()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--port", type=int, default=0, help="桩服务器端口, 0 表示随机")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), StubHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    BASE_URL = f"http://127.0.0.1:{server.server_address[1]}"
+
+    tests = [
+        ("SSE 解析", test_sse),
+        ("429/5xx 重试后成功", test_retry),
+        ("重试次数用尽", test_retry_exhausted),
+        ("4xx 不重试且释放连接", test_client_error),
+        ("响应头超时重试", test_header_timeout),
+        ("数据块间超时", test_chunk_timeout),
+        ("并发上限", test_concurrency),
+        ("健康检查", test_ping),
+    ]
+    passed = sum(check(name, func) for name, func in tests)
+    server.shutdown()
+    print(f"{passed}/{len(tests)} passed")
+    sys.exit(0 if passed == len(tests) else 1)
@@ -0,0 +1,94 @@
+'''
+连续批处理吞吐对比: 逐个生成(max_batch_size=1) vs 连续批处理
+
+    python benchmarks/bench_batching.py                          # 假后端, 模拟 GPU 每步耗时
+    python benchmarks/bench_batching.py --model <本地小模型路径>   # 真实模型(CPU 也可)
+'''
+import sys
+import time
+import random
+from pathlib import Path
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+root_dir = Path(__file__).parent.parent
+sys.path.append(str(root_dir))
+
+from model.batching import BatchScheduler, TransformersBatchBackend
+
+
+class FakeBackend:
+    '''
+    假后端: 每次前向耗时 = step_time + seq_cost * batch_size
+    (GPU decode 受显存带宽限制, 一个 step 的耗时对 batch 大小不敏感)
+    '''
+    eos_token_id = -1
+
+    def __init__(self, step_time: float = 0.02, seq_cost: float = 0.001):
+        self.step_time = step_time
+        self.seq_cost = seq_cost
+
+    def tokenize(self, messages: list) -> list:
+        return [1] * sum(len(m["content"]) for m in messages)
+
+    def detokenize(self, ids: list) -> str:
+        return "x" * len(ids)
+
+    def _forward(self, batch_size: int) -> list:
+        time.sleep(self.step_time + self.seq_cost * batch_size)
+        return [random.randint(0, 100) for _ in range(batch_size)]
+
+    def prefill(self, prompts: list):
+        return list(range(len(prompts))), self._forward(len(prompts))
+
+    def step(self, state, tokens: list):
+        return state, self._forward(len(state))
+
+    def concat(self, state_a, state_b):
+        return state_a + state_b
+
+    def filter(self, state, keep: list):
+        return [state[i] for i in keep]
+
+
+def load_backend(model_path: str):
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+    model = AutoModelForCausalLM.from_pretrained(model_path, torch_dtype="auto")
+    tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
+    return TransformersBatchBackend(model, tokenizer, do_sample=False)
+
+
+def run(backend, num_requests: int, max_batch_size: int, max_new_tokens: int) -> dict:
+    scheduler = BatchScheduler(backend, max_batch_size=max_batch_size, max_new_tokens=max_new_tokens)
+    scheduler.start()
+    requests = [
+        [{"role": "system", "content": "你是DeepSeek-R1，一个非常有用的AI助手。"},
+         {"role": "user", "content": f"第{i}个问题: 锐评一下 zhw"}]
+        for i in range(num_requests)
+    ]
+    end = time.time()
+    with ThreadPoolExecutor(max_workers=num_requests) as pool:
+        outputs = list(pool.map(scheduler.generate, requests))
+    wall_time = time.time() - end
+    scheduler.stop()
+    token_num = sum(o["token_num"] for o in outputs)
+    return {
+        "wall_time": wall_time,
+        "token_num": token_num,
+        "throughput": token_num / wall_time,
+        "avg_cost_time": sum(o["cost_time"] for o in outputs) / len(outputs),
+    }
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--model", type=str, default=None, help="本地模型路径, 不指定则使用假后端")
+    parser.add_argument("--requests", type=int, default=16)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    args = parser.parse_args()
+
+    backend = load_backend(args.model) if args.model else FakeBackend()
+    for name, batch_size in (("one-at-a-time", 1), ("continuous batching", args.batch_size)):
+        res = run(backend, args.requests, batch_size, args.max_new_tokens)
+        print(f"{name:<20} | Wall time: {res['wall_time']:.2f}s | Token nums: {res['token_num']} | "
+              f"Throughput: {res['throughput']:.2f} token/s | Avg cost time: {res['avg_cost_time']:.2f}s")
@@ -0,0 +1,118 @@
+'''
+群回复 @ 昵称查询: wcf.get_alias_in_chatroom(每个 @ 两条 SQL) vs ContactCache(每个群一条 SQL)
+使用模拟的 Wcf, 每次 query_sql 有固定的 RPC 延迟; 同时校验两种方式得到的昵称一致
+
+    python benchmarks/bench_contacts.py
+'''
+import sys
+import json
+import time
+import random
+import tempfile
+from pathlib import Path
+from argparse import ArgumentParser
+root_dir = Path(__file__).parent.parent
+sys.path.append(str(root_dir))
+
+from utils.contacts import ContactCache
+
+
+def parse_fake_room_data(data: bytes) -> dict:
+    return json.loads(data.decode('utf-8'))
+
+
+class FakeWcf:
+    '''
+    模拟 Wcf 的 query_sql / get_alias_in_chatroom, RoomData 用 json 代替 protobuf
+    '''
+    def __init__(self, contacts: dict, rooms: dict, latency: float = 0.002):
+        self.contacts = contacts  # {wxid: NickName}
+        self.rooms = rooms  # {roomid: {wxid: 群昵称}}
+        self.latency = latency
+        self.queries = 0
+
+    def query_sql(self, db: str, sql: str) -> list:
+        self.queries += 1
+        time.sleep(self.latency)
+        if sql.startswith("SELECT UserName, NickName FROM Contact"):
+            return [{"UserName": wxid, "NickName": name} for wxid, name in self.contacts.items()]
+        if sql.startswith("SELECT NickName FROM Contact"):
+            wxid = sql.split("'")[1]
+            return [{"NickName": self.contacts[wxid]}] if wxid in self.contacts else []
+        if sql.startswith("SELECT RoomData FROM ChatRoom"):
+            roomid = sql.split("'")[1]
+            if roomid not in self.rooms:
+                return []
+            return [{"RoomData": json.dumps(self.rooms[roomid]).encode('utf-8')}]
+        raise ValueError(sql)
+
+    def get_alias_in_chatroom(self, wxid: str, roomid: str) -> str:
+        '''
+        与 wcferry 的实现相同: 先查昵称, 再查整个群的 RoomData
+        '''
+        nickname = self.query_sql("MicroMsg.db", f"SELECT NickName FROM Contact WHERE UserName = '{wxid}';")
+        if not nickname:
+            return ""
+        rows = self.query_sql("MicroMsg.db", f"SELECT RoomData FROM ChatRoom WHERE ChatRoomName = '{roomid}';")
+        if not rows:
+            return ""
+        members = parse_fake_room_data(rows[0]["RoomData"])
+        if wxid not in members:
+            return ""
+        return members[wxid] or nickname[0]["NickName"]
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--rooms", type=int, default=5)
+    parser.add_argument("--members", type=int, default=300)
+    parser.add_argument("--replies", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.002, help="每次 query_sql 的延迟(s)")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    contacts, rooms = {}, {}
+    for r in range(args.rooms):
+        members = {}
+        for m in range(args.members):
+            wxid = f"wxid_{r}_{m}"
+            contacts[wxid] = f"nick_{r}_{m}"
+            members[wxid] = f"alias_{r}_{m}" if rng.random() < 0.5 else ""
+        rooms[f"{r}@chatroom"] = members
+    replies = []
+    for _ in range(args.replies):
+        roomid = rng.choice(list(rooms))
+        replies.append((roomid, rng.sample(list(rooms[roomid]), rng.randint(1, 3))))
+
+    wcf = FakeWcf(contacts, rooms, latency=args.latency)
+    end = time.time()
+    expected = [[wcf.get_alias_in_chatroom(wxid, roomid) for wxid in wxids] for roomid, wxids in replies]
+    rpc_time, rpc_queries = time.time() - end, wcf.queries
+
+    snapshot = str(Path(tempfile.mkdtemp()) / "contacts.json")
+    wcf.queries = 0
+    cache = ContactCache(wcf, snapshot_path=snapshot, room_parser=parse_fake_room_data)
+    end = time.time()
+    cache.load_contacts()
+    got = [[cache.alias(wxid, roomid) for wxid in wxids] for roomid, wxids in replies]
+    cache_time, cache_queries = time.time() - end, wcf.queries
+    assert got == expected, "ContactCache 与 get_alias_in_chatroom 结果不一致"
+
+    # 从快照重启: 不需要任何查询即可得到昵称
+    cache.save()
+    wcf.queries = 0
+    restarted = ContactCache(wcf, snapshot_path=snapshot, room_parser=parse_fake_room_data)
+    restarted.restore()
+    assert [[restarted.alias(wxid, roomid) for wxid in wxids] for roomid, wxids in replies] == expected
+    restart_queries = wcf.queries
+
+    # 新入群的成员: 超过 miss_reload_seconds 后按需重新加载该群
+    roomid = replies[0][0]
+    rooms[roomid]["wxid_new"] = "newcomer"
+    cache.miss_reload_seconds = 0
+    assert cache.alias("wxid_new", roomid) == "newcomer"
+
+    print(f"replies: {len(replies)} | rooms: {args.rooms} | members/room: {args.members} | rpc latency: {args.latency * 1000:.1f} ms")
+    print(f"get_alias_in_chatroom | {rpc_queries:5d} queries | {rpc_time * 1000:8.1f} ms")
+    print(f"ContactCache          | {cache_queries:5d} queries | {cache_time * 1000:8.1f} ms")
+    print(f"restart from snapshot | {restart_queries:5d} queries")
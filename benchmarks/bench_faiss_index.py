@@ -0,0 +1,77 @@
+'''
+Faiss 索引类型对比: 以 flat 精确检索为基准, 统计 recall@k、单条查询 p50/p99 延迟、构建耗时与索引内存
+
+    python benchmarks/bench_faiss_index.py --num 200000 --dim 768
+'''
+import sys
+import time
+from pathlib import Path
+from argparse import ArgumentParser
+root_dir = Path(__file__).parent.parent
+sys.path.append(str(root_dir))
+
+import faiss
+import numpy as np
+from model.FaissIndexer import build_ann_index, set_search_params
+
+
+def synthetic_vectors(num: int, dim: int, clusters: int = 100, seed: int = 0) -> np.ndarray:
+    '''
+    带聚类结构的合成向量(比均匀随机向量更接近真实句向量分布)
+    '''
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim)).astype('float32')
+    labels = rng.integers(0, clusters, size=num)
+    return centers[labels] + 0.3 * rng.normal(size=(num, dim)).astype('float32')
+
+
+def query_latencies(index, queries: np.ndarray, top_k: int):
+    latencies, results = [], []
+    for query in queries:
+        end = time.perf_counter()
+        _, indices = index.search(query[None, :], top_k)
+        latencies.append(time.perf_counter() - end)
+        results.append(indices[0])
+    return np.array(latencies), np.stack(results)
+
+
+def recall_at_k(results: np.ndarray, truth: np.ndarray) -> float:
+    hits = sum(len(set(r[r >= 0]) & set(t)) for r, t in zip(results, truth))
+    return hits / truth.size
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--num", type=int, default=100000)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--topk", type=int, default=5)
+    parser.add_argument("--metric", type=str, default="l2", choices=("l2", "ip"))
+    parser.add_argument("--nlist", type=int, default=1024)
+    parser.add_argument("--pq-m", type=int, default=48)
+    parser.add_argument("--hnsw-m", type=int, default=32)
+    parser.add_argument("--nprobe", type=int, default=16)
+    parser.add_argument("--ef-search", type=int, default=64)
+    args = parser.parse_args()
+
+    vectors = synthetic_vectors(args.num, args.dim)
+    queries = synthetic_vectors(args.queries, args.dim, seed=1)
+    if args.metric == "ip":
+        faiss.normalize_L2(queries)
+    ids = np.arange(args.num)
+
+    truth = None
+    print(f"num: {args.num} | dim: {args.dim} | metric: {args.metric} | top{args.topk}")
+    for index_type in ("flat", "hnsw", "ivf_flat", "ivf_pq"):
+        end = time.perf_counter()
+        index = build_ann_index(vectors, ids, index_type=index_type, metric=args.metric,
+                                nlist=args.nlist, pq_m=args.pq_m, hnsw_m=args.hnsw_m)
+        build_time = time.perf_counter() - end
+        set_search_params(index, nprobe=args.nprobe, ef_search=args.ef_search)
+        latencies, results = query_latencies(index, queries, args.topk)
+        if truth is None:
+            truth = results  # flat 为精确结果
+        memory = faiss.serialize_index(index).nbytes / 1024 / 1024
+        print(f"{index_type:<9} | recall@{args.topk}: {recall_at_k(results, truth):.4f} | "
+              f"p50: {np.percentile(latencies, 50) * 1000:.3f} ms | p99: {np.percentile(latencies, 99) * 1000:.3f} ms | "
+              f"build: {build_time:.1f}s | memory: {memory:.1f} MB")
@@ -0,0 +1,361 @@
+'''
+离线回放 & 压测: 假 Wcf + 假模型, 按指定速率把消息轨迹送入 Robot.enableReceivingMsg,
+统计端到端延迟(消息进入 get_msg 队列 -> 回复调用 send_text / 同意好友)、吞吐与队列深度
+
+    python benchmarks/bench_replay.py                                    # 合成轨迹
+    python benchmarks/bench_replay.py --rate 5 --messages 500 --token-rate 20
+    python benchmarks/bench_replay.py --save-trace trace.jsonl           # 保存合成轨迹
+    python benchmarks/bench_replay.py --trace trace.jsonl --speed 2      # 2 倍速回放已有轨迹
+    python benchmarks/bench_replay.py --json report.json --max-p95 30    # CI: p95 超过 30s 时退出码为 1
+
+轨迹为 jsonl, 每行: {"t": 相对开始的秒数, "type": "group" | "private" | "friend", "sender": wxid, "roomid": 群 id, "content": 文本}
+'''
+import re
+import sys
+import json
+import time
+import random
+import logging
+import tempfile
+from pathlib import Path
+from queue import Queue
+from threading import Lock, Semaphore, Thread
+from argparse import ArgumentParser
+root_dir = Path(__file__).parent.parent
+sys.path.append(str(root_dir))
+
+from wcferry import WxMsg, wcf_pb2
+from configs.robot_config import Config
+from robot import Robot
+from utils.metrics import metrics
+
+QUESTIONS = (
+    "今天天气怎么样", "帮我写一首关于春天的诗", "解释一下什么是注意力机制", "推荐几本好看的科幻小说",
+    "Python 里列表和元组有什么区别", "晚饭吃什么好", "讲个笑话", "他是谁", "介绍一下你自己", "怎么学好数学",
+)
+ID_PATTERN = re.compile(r"#(\d+)")
+
+
+class FakeWcf:
+    '''
+    模拟 Wcf: get_msg 从队列取消息, send_text / query_sql / accept_new_friend 只记录
+    '''
+    def __init__(self, wxid: str = "wxid_bot", contacts: dict = None, on_reply=None):
+        self.wxid = wxid
+        self.contacts = contacts or {}  # {wxid: NickName}
+        self.on_reply = on_reply  # on_reply(text), 收到回复时回调
+        self.msgQ = Queue()
+        self.receiving = False
+        self.sent = []  # [(time, receiver, text, aters)]
+        self.queries = 0
+        self.lock = Lock()
+
+    def get_self_wxid(self) -> str:
+        return self.wxid
+
+    def get_user_info(self) -> dict:
+        return {"wxid": self.wxid, "name": "bot", "mobile": "", "home": ""}
+
+    def enable_receiving_msg(self) -> bool:
+        self.receiving = True
+        return True
+
+    def disable_recv_msg(self) -> None:
+        self.receiving = False
+
+    def is_receiving_msg(self) -> bool:
+        return self.receiving
+
+    def get_msg(self, block: bool = True) -> WxMsg:
+        return self.msgQ.get(block, timeout=1)
+
+    def send_text(self, msg: str, receiver: str, aters: str = "") -> int:
+        with self.lock:
+            self.sent.append((time.perf_counter(), receiver, msg, aters))
+        if self.on_reply is not None:
+            self.on_reply(msg)
+        return 0
+
+    def query_sql(self, db: str, sql: str) -> list:
+        with self.lock:
+            self.queries += 1
+        if sql.startswith("SELECT UserName, NickName FROM Contact"):
+            return [{"UserName": wxid, "NickName": name} for wxid, name in self.contacts.items()]
+        return []
+
+    def accept_new_friend(self, v3: str, v4: str, scene: int = 30) -> int:
+        if self.on_reply is not None:
+            self.on_reply(v3)
+        return 1
+
+    def cleanup(self) -> None:
+        self.receiving = False
+
+
+class FakeStream:
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self.thinking = False  # 假模型的输出自带 <think>
+        self.outputs = None
+
+    def __iter__(self):
+        self.outputs = yield from self._chunks
+
+
+class FakeDeepSeek:
+    '''
+    假模型: 首 token 延迟 ttft, 之后每秒生成 token_rate 个 token; 同时生成的请求数不超过 concurrency
+    回复中带上最新一条用户消息里的 #id, 用于统计端到端延迟
+    '''
+    def __init__(self, token_rate: float = 30.0, ttft: float = 0.3, think_tokens: int = 32,
+                 answer_tokens: int = 32, concurrency: int = 1, history: int = 3):
+        self.role = "default"
+        self.default_messages = [{"role": "system", "content": "你是一个乐于助人的助手"}]
+        self.token_rate = token_rate
+        self.ttft = ttft
+        self.think_tokens = think_tokens
+        self.answer_tokens = answer_tokens
+        self.history = history
+        self.semaphore = Semaphore(concurrency)
+
+    def clean_history_messages(self, messages: list, history: int = None, key=None, reserve: int = 0) -> list:
+        history = self.history if history is None else history
+        return messages[:1] + messages[1:][-(2 * history + 1):] if history else messages[:1]
+
+    def _generate(self, messages: list):
+        ids = " ".join(f"#{i}" for i in ID_PATTERN.findall(messages[-1]["content"]))
+        pieces = ["<think>\n"] + ["嗯"] * self.think_tokens + ["\n</think>\n\n"] + ["好"] * self.answer_tokens + [f"。{ids}"]
+        with self.semaphore:
+            end = time.time()
+            time.sleep(self.ttft)
+            for i, piece in enumerate(pieces):
+                if i % 8 == 0:
+                    time.sleep(8 / self.token_rate)
+                yield piece
+        cost_time = time.time() - end
+        token_num = self.think_tokens + self.answer_tokens
+        return {
+            "response": "".join(pieces),
+            "token_num": token_num,
+            "token_speed": token_num / cost_time,
+            "cost_time": cost_time,
+            "ttft": self.ttft,
+        }
+
+    def generate(self, messages: list, key=None) -> dict:
+        chunks = self._generate(messages)
+        while True:
+            try:
+                next(chunks)
+            except StopIteration as e:
+                return e.value
+
+    def generate_stream(self, messages: list, key=None) -> FakeStream:
+        return FakeStream(self._generate(messages))
+
+
+class ReplayRobot(Robot):
+    '''
+    使用假模型, 不加载检索索引
+    '''
+    def __init__(self, config: Config, wcf: FakeWcf, model: FakeDeepSeek) -> None:
+        self.fakeModel = model
+        super().__init__(config, wcf, model_name="fake")
+
+    def initRetrieval(self, executor) -> None:
+        pass
+
+    def initModel(self) -> None:
+        self.model = self.fakeModel
+        self.modelReady.set()
+
+
+def synthetic_trace(num: int, rate: float, mix: dict, users: int, rooms: int, burst_prob: float, seed: int = 0) -> list:
+    '''
+    泊松到达的合成轨迹; 以 burst_prob 的概率紧接着再发一条(测试消息合并)
+    '''
+    rng = random.Random(seed)
+    kinds, weights = list(mix), list(mix.values())
+    trace, t = [], 0.0
+    while len(trace) < num:
+        t += rng.expovariate(rate)
+        kind = rng.choices(kinds, weights)[0]
+        user = rng.randrange(users)
+        event = {"t": round(t, 3), "type": kind, "sender": f"wxid_user{user}",
+                 "roomid": f"{user % rooms}@chatroom" if kind == "group" else "", "content": rng.choice(QUESTIONS)}
+        trace.append(event)
+        if kind != "friend" and rng.random() < burst_prob and len(trace) < num:
+            trace.append({**event, "t": round(t + rng.uniform(0.1, 0.5), 3), "content": rng.choice(QUESTIONS)})
+    trace.sort(key=lambda e: e["t"])
+    return trace
+
+
+def make_msg(event: dict, msg_id: int, self_wxid: str) -> WxMsg:
+    kind = event["type"]
+    if kind == "friend":
+        content = (f'<msg fromusername="{event["sender"]}" encryptusername="v3_#{msg_id}" '
+                   f'ticket="v4_{msg_id}" scene="30" />')
+        pb = wcf_pb2.WxMsg(is_self=False, is_group=False, id=msg_id, type=37, ts=int(time.time()),
+                           sender="fmessage", content=content)
+    elif kind == "group":
+        pb = wcf_pb2.WxMsg(is_self=False, is_group=True, id=msg_id, type=1, ts=int(time.time()),
+                           roomid=event["roomid"], sender=event["sender"], content=f"@bot {event['content']} [#{msg_id}]",
+                           xml=f"<msgsource><atuserlist>{self_wxid}</atuserlist></msgsource>")
+    else:
+        pb = wcf_pb2.WxMsg(is_self=False, is_group=False, id=msg_id, type=1, ts=int(time.time()),
+                           sender=event["sender"], content=f"{event['content']} [#{msg_id}]")
+    return WxMsg(pb)
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--trace", type=str, default=None, help="回放的轨迹文件(jsonl), 为空时使用合成轨迹")
+    parser.add_argument("--save-trace", type=str, default=None, help="保存合成轨迹")
+    parser.add_argument("--speed", type=float, default=1.0, help="回放倍速")
+    parser.add_argument("--messages", type=int, default=200, help="合成轨迹的消息数")
+    parser.add_argument("--rate", type=float, default=2.0, help="合成轨迹平均每秒消息数")
+    parser.add_argument("--mix", type=str, default="group:0.6,private:0.35,friend:0.05", help="各类消息占比")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--rooms", type=int, default=3)
+    parser.add_argument("--burst-prob", type=float, default=0.1, help="连续发送两条消息的概率")
+    parser.add_argument("--token-rate", type=float, default=30.0, help="假模型每秒生成 token 数")
+    parser.add_argument("--ttft", type=float, default=0.3, help="假模型首 token 延迟(s)")
+    parser.add_argument("--think-tokens", type=int, default=32)
+    parser.add_argument("--answer-tokens", type=int, default=32)
+    parser.add_argument("--concurrency", type=int, default=1, help="假模型同时生成的请求数")
+    parser.add_argument("--stream", action="store_true", help="流式回复")
+    parser.add_argument("--no-rate-limit", action="store_true", help="关闭发送限速")
+    parser.add_argument("--timeout", type=float, default=120.0, help="最后一条消息送出后最多等待的时间(s)")
+    parser.add_argument("--json", type=str, default=None, help="结果写入 json 文件")
+    parser.add_argument("--max-p95", type=float, default=None, help="端到端 p95 超过该值(s)时退出码为 1")
+    args = parser.parse_args()
+
+    if args.trace:
+        with open(args.trace, 'r', encoding='utf-8') as fin:
+            trace = [json.loads(line) for line in fin if line.strip()]
+    else:
+        mix = {kind: float(weight) for kind, weight in (item.split(":") for item in args.mix.split(","))}
+        trace = synthetic_trace(args.messages, args.rate, mix, args.users, args.rooms, args.burst_prob)
+        if args.save_trace:
+            with open(args.save_trace, 'w', encoding='utf-8') as fout:
+                fout.writelines(json.dumps(event, ensure_ascii=False) + "\n" for event in trace)
+
+    submitted = {}  # {msg_id: (类型, 进入队列的时间)}
+    latencies = {}  # {msg_id: 端到端延迟}
+    lock = Lock()
+
+    def on_reply(text: str) -> None:
+        now = time.perf_counter()
+        with lock:
+            for msg_id in ID_PATTERN.findall(text):
+                msg_id = int(msg_id)
+                if msg_id in submitted and msg_id not in latencies:
+                    latencies[msg_id] = now - submitted[msg_id][1]
+
+    # 使用临时目录保存会话与联系人快照, 不影响正式数据
+    tmp_dir = Path(tempfile.mkdtemp())
+    config = Config()
+    logging.getLogger().setLevel(logging.WARNING)
+    config.GROUPS = sorted({event["roomid"] for event in trace if event["type"] == "group"})
+    config.METRICS = {}
+    config.CONVERSATION = {**config.CONVERSATION, "db_path": str(tmp_dir / "conversations.db")}
+    config.CONTACTS = {"cache": {"snapshot_path": str(tmp_dir / "contacts.json")}}
+    if args.no_rate_limit:
+        config.SENDER = {**config.SENDER, "receiver_rate": 1e6, "receiver_burst": 1000000,
+                         "global_rate": 1e6, "global_burst": 1000000}
+    wcf = FakeWcf(contacts={event["sender"]: event["sender"] for event in trace}, on_reply=on_reply)
+    model = FakeDeepSeek(args.token_rate, args.ttft, args.think_tokens, args.answer_tokens, args.concurrency)
+    robot = ReplayRobot(config, wcf, model)
+    robot.user_default_config['stream'] = args.stream
+    robot.initialized.wait()
+    robot.enableReceivingMsg()
+
+    # 采样队列深度
+    depth = {"dispatcher": [], "sender": []}
+    replaying = True
+
+    def sample() -> None:
+        while replaying:
+            depth["dispatcher"].append(robot.dispatcher.qsize())
+            depth["sender"].append(robot.sender.pending)
+            time.sleep(0.05)
+
+    Thread(target=sample, name="DepthSampler", daemon=True).start()
+
+    start = time.perf_counter()
+    for msg_id, event in enumerate(trace):
+        delay = start + event["t"] / args.speed - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        msg = make_msg(event, msg_id, wcf.wxid)
+        with lock:
+            submitted[msg_id] = (event["type"], time.perf_counter())
+        wcf.msgQ.put(msg)
+    replay_time = time.perf_counter() - start
+
+    # 等待队列清空
+    deadline = time.perf_counter() + args.timeout
+    while time.perf_counter() < deadline:
+        time.sleep(0.1)
+        if wcf.msgQ.empty() and robot.dispatcher.qsize() == 0 and robot.dispatcher.running == 0 and robot.sender.pending == 0:
+            break
+    replaying = False
+    end = max((submitted[msg_id][1] + latency for msg_id, latency in latencies.items()), default=start)
+    wcf.disable_recv_msg()
+    robot.sender.stop()
+    robot.dispatcher.shutdown(wait=False)
+
+    values = list(latencies.values())
+    by_type = {}
+    for msg_id, (kind, _) in submitted.items():
+        by_type.setdefault(kind, []).append(latencies.get(msg_id))
+    report = {
+        "messages": len(trace),
+        "answered": len(latencies),
+        "unanswered": len(trace) - len(latencies),
+        "replay_seconds": replay_time,
+        "throughput": len(latencies) / (end - start) if end > start else 0.0,
+        "e2e_p50": percentile(values, 0.5),
+        "e2e_p95": percentile(values, 0.95),
+        "e2e_p99": percentile(values, 0.99),
+        "e2e_max": max(values, default=0.0),
+        "by_type": {
+            kind: {"count": len(items), "answered": sum(v is not None for v in items),
+                   "p50": percentile([v for v in items if v is not None], 0.5),
+                   "p95": percentile([v for v in items if v is not None], 0.95)}
+            for kind, items in sorted(by_type.items())
+        },
+        "queue_depth": {
+            name: {"max": max(samples, default=0), "avg": sum(samples) / len(samples) if samples else 0.0}
+            for name, samples in depth.items()
+        },
+        "stages": metrics.snapshot()["histograms"],
+        "counters": metrics.snapshot()["counters"],
+    }
+
+    print(f"messages: {report['messages']} | answered: {report['answered']} | unanswered: {report['unanswered']} | "
+          f"replay: {replay_time:.1f}s | throughput: {report['throughput']:.2f} msg/s")
+    print(f"end-to-end | p50 {report['e2e_p50']:.2f}s | p95 {report['e2e_p95']:.2f}s | "
+          f"p99 {report['e2e_p99']:.2f}s | max {report['e2e_max']:.2f}s")
+    for kind, stats in report["by_type"].items():
+        print(f"  {kind:8s} | {stats['answered']:4d}/{stats['count']:<4d} | p50 {stats['p50']:.2f}s | p95 {stats['p95']:.2f}s")
+    for name, stats in report["queue_depth"].items():
+        print(f"queue depth {name:10s} | max {stats['max']:4d} | avg {stats['avg']:.1f}")
+    for name, stats in report["stages"].items():
+        print(f"{name:40s} | {stats['count']:5d} | avg {stats['avg'] * 1000:9.1f} ms | p95 <= {stats['p95']}s")
+    for name, value in report["counters"].items():
+        print(f"{name:40s} | {value}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as fout:
+            json.dump(report, fout, ensure_ascii=False, indent=2)
+    if args.max_p95 is not None and report["e2e_p95"] > args.max_p95:
+        print(f"e2e p95 {report['e2e_p95']:.2f}s 超过 {args.max_p95}s")
+        sys.exit(1)
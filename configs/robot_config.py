@@ -30,3 +30,10 @@ class Config(object):
         self.GROUPS = yconfig["groups"]["enable"]
         self.NEWS = yconfig["news"]["receivers"]
         self.REPORT_REMINDERS = yconfig["report_reminder"]["receivers"]
+        self.DISPATCHER = yconfig.get("dispatcher", None) or {}
+        self.RETRIEVAL = yconfig.get("retrieval", None) or {}
+        self.CONVERSATION = yconfig.get("conversation", None) or {}
+        self.STARTUP = yconfig.get("startup", None) or {}
+        self.CONTACTS = yconfig.get("contacts", None) or {}
+        self.SENDER = yconfig.get("sender", None) or {}
+        self.METRICS = yconfig.get("metrics", None) or {}
@@ -2,30 +2,54 @@
 # -*- coding: utf-8 -*-
 import signal
 from argparse import ArgumentParser
+from threading import Thread
 
-from configs.robot_config import Config
-from robot import Robot, __version__
-from wcferry import Wcf
+from utils.startup import StartupProfiler
+
+profiler = StartupProfiler()  # 尽早创建, 统计包括导入在内的启动耗时
+
+with profiler.phase("import"):
+    from configs.robot_config import Config
+    from robot import Robot, __version__
+    from wcferry import Wcf
 
 def main():
+    parser = ArgumentParser()
+    parser.add_argument("--profile-startup", action="store_true", help="初始化完成后输出启动各阶段耗时")
+    args = parser.parse_args()
+
     config = Config()
-    wcf = Wcf(debug=True)
+    with profiler.phase("wcf"):
+        wcf = Wcf(debug=True)
+
+    robot = None
 
     def handler(sig, frame):
+        if robot is not None:
+            robot.user.flush()  # 内存中的会话写入磁盘, 重启后恢复
+            robot.sender.stop()  # 发送完排队中的消息
         wcf.cleanup()  # 退出前清理环境
         exit(0)
 
     signal.signal(signal.SIGINT, handler)
 
-    robot = Robot(config, wcf, model_name="deepseek")
+    robot = Robot(config, wcf, model_name="deepseek", profiler=profiler)
     robot.LOG.info(f"WeChatRobot {__version__} 成功启动···")
 
     # 机器人启动发送测试消息
     robot.sendTextMsg(msg="机器人启动成功！", receiver="filehelper")
 
-    # 接收消息
+    # 接收消息(模型等仍在后台加载, 期间消息进入队列等待)
     # robot.enableRecvMsg()     # 可能会丢消息？
     robot.enableReceivingMsg()  # 加队列
+    profiler.mark("receiving_msg")
+
+    if args.profile_startup:
+        def report():
+            robot.initialized.wait()
+            robot.LOG.info(f"启动耗时:\n{profiler.report()}")
+
+        Thread(target=report, name="StartupReport", daemon=True).start()
 
     # 让机器人一直跑
     robot.keepRunningAndBlockProcess()
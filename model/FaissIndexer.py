@@ -1,46 +1,380 @@
 import os
 import sys
+import json
 import faiss
+import hashlib
+import logging
 import numpy as np
+from threading import Lock
+from collections import OrderedDict
 
 sys.path.append("..")
 from utils.utils import text_to_vector, extract_name
-from sentence_transformers import SentenceTransformer
+from model.string_table import StringTable
+from utils.metrics import metrics
+from utils.name_matcher import get_name_matcher
 
 EMBEDDING_SIZE = 768
+LOG = logging.getLogger("FaissIndexer")
+
+def normalize_query(query: str, names=()) -> str:
+    '''
+    查询的缓存 key: 逗号分隔且每一项都是已知人名时去空格、去重、排序, 使 "zhw,lzy" 与 "lzy, zhw" 命中同一缓存;
+    其他查询只去掉首尾空白, 不改变内容
+    '''
+    parts = [part.strip() for part in query.split(",")]
+    if len(parts) > 1 and all(part in names for part in parts):
+        return ",".join(sorted(set(parts)))
+    return query.strip()
+
+INDEX_TYPES = ("flat", "hnsw", "ivf_flat", "ivf_pq")
+
+def build_ann_index(vectors, ids, index_type="flat", metric="l2", nlist=100, pq_m=16, hnsw_m=32):
+    '''
+    构建(并训练) IDMap2 包装的 Faiss 索引
+    Args:
+        index_type: flat 精确检索 | hnsw 图索引 | ivf_flat 倒排 | ivf_pq 倒排+乘积量化(省内存)
+        metric: l2 | ip (内积, 向量先归一化, 等价于余弦相似度)
+    '''
+    assert index_type in INDEX_TYPES, f"index_type should be in {INDEX_TYPES}, but got {index_type}"
+    n, dim = vectors.shape
+    vectors = np.ascontiguousarray(vectors, dtype='float32')
+    if metric == "ip":
+        vectors = vectors.copy()
+        faiss.normalize_L2(vectors)
+    # 训练样本不足时退化为精确检索
+    min_train = max(nlist, 256) if index_type == "ivf_pq" else nlist
+    if index_type.startswith("ivf") and n < min_train:
+        LOG.warning(f"向量数 {n} 少于 {index_type} 训练所需的 {min_train}，使用 flat 索引")
+        index_type = "flat"
+    description = {
+        "flat": "Flat",
+        "hnsw": f"HNSW{hnsw_m}",
+        "ivf_flat": f"IVF{nlist},Flat",
+        "ivf_pq": f"IVF{nlist},PQ{pq_m}",
+    }[index_type]
+    faiss_metric = faiss.METRIC_INNER_PRODUCT if metric == "ip" else faiss.METRIC_L2
+    index = faiss.index_factory(dim, f"IDMap2,{description}", faiss_metric)
+    if not index.is_trained:
+        index.train(vectors)
+    if n:
+        index.add_with_ids(vectors, np.asarray(ids, dtype='int64'))
+    return index
+
+def set_search_params(index, nprobe=8, ef_search=64):
+    '''
+    设置查询参数: IVF 的 nprobe / HNSW 的 efSearch, 对不适用的索引类型忽略
+    '''
+    params = faiss.ParameterSpace()
+    for name, value in (("nprobe", nprobe), ("efSearch", ef_search)):
+        try:
+            params.set_index_parameter(index, name, value)
+        except RuntimeError:
+            pass
+
+def copy_index(index):
+    # 通过序列化复制, 适用于所有索引类型
+    return faiss.deserialize_index(faiss.serialize_index(index))
+
+def chunk_text(text, chunk_size=300, overlap=50):
+    '''
+    把文档切分为带重叠的片段, 尽量在段落/换行/句末处断开
+    Return:
+        [(start, end), ...] 字符偏移
+    '''
+    spans = []
+    start, n = 0, len(text)
+    while start < n:
+        end = min(start + chunk_size, n)
+        if end < n:
+            for sep in ("\n\n", "\n", "。", "！", "？", ". "):
+                cut = text.rfind(sep, start + chunk_size // 2, end)
+                if cut != -1:
+                    end = cut + len(sep)
+                    break
+        if text[start:end].strip():
+            spans.append((start, end))
+        if end >= n:
+            break
+        start = max(end - overlap, start + 1)
+    return spans
 
 class FaissIndexer:
-    def __init__(self, bert_path="sbert-base-chinese-nli"):
-        self.model = SentenceTransformer(bert_path)
+    def __init__(self, bert_path="sbert-base-chinese-nli", cache_size=1024, index_type="flat", metric="l2",
+                 nlist=100, pq_m=16, hnsw_m=32, nprobe=8, ef_search=64,
+                 chunk_size=300, chunk_overlap=50, embed_batch_size=64, load_model=True):
+        '''
+        Args:
+            load_model: 为 False 时不立即加载向量模型, 之后调用 load_model(), 可与 load_index 并行
+        '''
+        self.bert_path = bert_path
+        self.model = None
+        if load_model:
+            self.load_model()
         # self.index = faiss.IndexFlatL2(dimension)
         self.index = None
-        self.filenames = []
+        # 索引结构参数(保存在清单中, 变化时全量重建) & 查询参数
+        self.index_params = {"index_type": index_type, "metric": metric, "nlist": nlist, "pq_m": pq_m, "hnsw_m": hnsw_m}
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        # 文档切片参数(变化时全量重建)
+        self.chunk_params = {"chunk_size": chunk_size, "chunk_overlap": chunk_overlap}
+        self.embed_batch_size = embed_batch_size
+        # 每个片段: id -> 所属文件名, spans 与 filenames.ids 对齐, 为片段在文件中的 [start, end)
+        self.filenames = StringTable.from_list([])
+        self.spans = np.zeros((0, 2), dtype='int64')
+        # 增量构建清单 {"next_id": int, "entries": {filename: {"ids": [int, ...], "hash": str}}, "index": {...}, "chunk": {...}}
+        self.manifest = {"next_id": 0, "entries": {}}
+        self.unsaved = False  # 上次同步后保存失败, 下次同步时即使没有变化也重新保存
+        self.sync_lock = Lock()
+        self.swap_lock = Lock()  # 保证 index / filenames / spans 同时替换
+        # 查询向量 LRU 缓存 {normalized_query: vector}
+        self.cache_size = cache_size
+        self.query_cache = OrderedDict()
+        self.cache_lock = Lock()
     
-    def create_index(self, file_list):
+    def load_model(self):
+        from sentence_transformers import SentenceTransformer  # 导入较慢, 用到时再导入
+        self.model = SentenceTransformer(self.bert_path)
+
+    def create_index(self, file_list, pre_info_dir="pre_info"):
+        """
+        创建索引并保存关联数据(对 file_list 中的文档全量切片、计算向量)
+        """
+        with self.sync_lock:
+            self.index = None
+            self.manifest = {"next_id": 0, "entries": {}}
+        self.sync(pre_info_dir, save_dir=None, names=file_list)
+
+    @staticmethod
+    def _stat_dir(pre_info_dir, names=None, entries=None):
+        """
+        文档的 sha1 与 mtime/size; mtime 和 size 与清单记录一致的文档沿用清单中的 hash, 不重新读取
+        Return:
+            {filename: {"hash": sha1, "mtime": mtime_ns, "size": size}}
         """
-        创建索引并保存关联数据
+        files = {}
+        for file in os.listdir(pre_info_dir):
+            name = file.split('.')[0]
+            if names is not None and name not in names:
+                continue
+            path = os.path.join(pre_info_dir, file)
+            stat = os.stat(path)
+            entry = (entries or {}).get(name) or {}
+            if entry.get("mtime") == stat.st_mtime_ns and entry.get("size") == stat.st_size:
+                digest = entry["hash"]
+            else:
+                with open(path, 'rb') as fin:
+                    digest = hashlib.sha1(fin.read()).hexdigest()
+            files[name] = {"hash": digest, "mtime": stat.st_mtime_ns, "size": stat.st_size}
+        return files
+
+    def _chunk_files(self, pre_info_dir, names):
+        """
+        切分文档
+        Return:
+            [(filename, start, end, text_to_embed), ...]
+        """
+        chunks = []
+        for name in names:
+            # 与 utils.load_search_file 一致, 以文本模式读取, 偏移基于统一换行后的文本
+            with open(os.path.join(pre_info_dir, f"{name}.txt"), 'r', encoding='utf-8') as fin:
+                text = fin.read()
+            for start, end in chunk_text(text, self.chunk_params["chunk_size"], self.chunk_params["chunk_overlap"]):
+                # 片段前加上文件名(人名), 使只包含人名的查询也能命中
+                chunks.append((name, start, end, f"{name}\n{text[start:end]}"))
+        return chunks
+
+    def sync(self, pre_info_dir="pre_info", save_dir="index", names=None):
+        """
+        按清单增量同步 pre_info: 只对新增/修改的文档切片并计算向量, 删除已移除文档的片段,
+        在副本上修改完成后再替换, 同步期间不影响搜索
+        Return:
+            是否有变化
         """
-        # 生成文件名向量
-        file_vectors = self.model.encode(file_list)
-        
-        # 创建Faiss索引
-        self.index = faiss.IndexFlatL2(file_vectors.shape[1])
-        self.index.add(file_vectors.astype('float32'))
-        self.filenames = file_list
+        current = self._stat_dir(pre_info_dir, names, self.manifest["entries"])
+        with self.sync_lock:
+            entries = self.manifest["entries"]
+            next_id = self.manifest["next_id"]
+            # 旧格式索引、索引/切片参数变化或清单与索引不一致时全量重建
+            rebuild = self.index is None or self.manifest.get("index") != self.index_params or \
+                self.manifest.get("chunk") != self.chunk_params or \
+                self.index.ntotal != sum(len(entry["ids"]) for entry in entries.values())
+            if rebuild:
+                entries, next_id = {}, 0
+            removed = [name for name in entries if name not in current]
+            changed = [name for name, info in current.items() if name not in entries or entries[name]["hash"] != info["hash"]]
+            if not rebuild and not removed and not changed:
+                # 内容未变但 mtime 变化(如被 touch)的文档, 更新记录的 mtime, 下次不再读取
+                for name, info in current.items():
+                    entries[name].update(info)
+                if self.unsaved and save_dir is not None:
+                    self.save_index(save_dir)
+                    self.unsaved = False
+                return False
+            stale = [i for name in removed + changed if name in entries for i in entries[name]["ids"]]
+            if stale and self.index_params["index_type"] == "hnsw":
+                # HNSW 不支持删除, 全量重建
+                rebuild, entries, next_id, removed, changed, stale = True, {}, 0, [], list(current), []
+
+            # 保留未变化文档的片段
+            rows = {}
+            if not rebuild:
+                stale_set = set(stale)
+                for (chunk_id, name), span in zip(self.filenames.items(), self.spans):
+                    if chunk_id not in stale_set:
+                        rows[chunk_id] = (name, int(span[0]), int(span[1]))
+            new_entries = {name: {**entry, **current[name]} for name, entry in entries.items() if name not in removed and name not in changed}
+            chunks = self._chunk_files(pre_info_dir, changed)
+            ids = list(range(next_id, next_id + len(chunks)))
+            next_id += len(chunks)
+            for name in changed:
+                new_entries[name] = {"ids": [], **current[name]}
+            for chunk_id, (name, start, end, _) in zip(ids, chunks):
+                new_entries[name]["ids"].append(chunk_id)
+                rows[chunk_id] = (name, start, end)
+            if chunks:
+                vectors = self.model.encode([chunk[3] for chunk in chunks], batch_size=self.embed_batch_size).astype('float32')
+            else:
+                vectors = np.zeros((0, self.model.get_sentence_embedding_dimension()), dtype='float32')
+
+            if rebuild:
+                index = build_ann_index(vectors, ids, **self.index_params)
+            else:
+                index = copy_index(self.index)
+                if stale:
+                    index.remove_ids(np.array(stale, dtype='int64'))
+                if chunks:
+                    if self.index_params["metric"] == "ip":
+                        faiss.normalize_L2(vectors)
+                    index.add_with_ids(vectors, np.array(ids, dtype='int64'))
+            set_search_params(index, self.nprobe, self.ef_search)
+
+            table = StringTable.from_dict({chunk_id: row[0] for chunk_id, row in rows.items()})
+            spans = np.array([rows[int(chunk_id)][1:] for chunk_id in table.ids], dtype='int64').reshape(-1, 2)
+            with self.swap_lock:
+                self.index, self.filenames, self.spans = index, table, spans
+            self.manifest = {"next_id": next_id, "entries": new_entries, "index": self.index_params, "chunk": self.chunk_params}
+            LOG.info(f"索引同步完成: 新增/修改 {len(changed)} 个文档({len(chunks)} 个片段), 删除 {len(removed)} 个文档, 共 {index.ntotal} 个片段")
+            if save_dir is not None:
+                self.unsaved = True
+                self.save_index(save_dir)
+                self.unsaved = False
+        return True
 
     def add_vectors(self, vectors):
         self.index.add(np.array(vectors))
     
+    def encode_queries(self, queries):
+        """
+        查询编码, 命中缓存的直接返回, 未命中的合并为一次前向计算
+        归一化的查询只作为缓存 key, 编码的始终是原始文本
+        Return:
+            np.ndarray, (len(queries), dim)
+        """
+        names = get_name_matcher().names
+        keys = [normalize_query(query, names) for query in queries]
+        vectors = {}
+        with self.cache_lock:
+            for key in keys:
+                if key in self.query_cache:
+                    self.query_cache.move_to_end(key)
+                    vectors[key] = self.query_cache[key]
+        misses = {}  # {key: 原始查询}
+        for key, query in zip(keys, queries):
+            if key not in vectors and key not in misses:
+                misses[key] = query
+        if misses:
+            with metrics.stage("embedding"):
+                miss_vectors = self.model.encode(list(misses.values())).astype('float32')
+            with self.cache_lock:
+                for key, vector in zip(misses, miss_vectors):
+                    vectors[key] = vector
+                    self.query_cache[key] = vector
+                while len(self.query_cache) > self.cache_size:
+                    self.query_cache.popitem(last=False)
+        return np.stack([vectors[key] for key in keys])
+
+    def search_ids_batch(self, queries, top_k=5):
+        """
+        批量搜索: 一次编码, 一次 index.search
+        Return:
+            [[(chunk_id, distance), ...], ...]
+        """
+        query_vectors = self.encode_queries(queries)
+        if self.index_params["metric"] == "ip":
+            faiss.normalize_L2(query_vectors)
+        with self.swap_lock:
+            index = self.index
+        with metrics.stage("faiss_search"):
+            distances, indices = index.search(query_vectors, top_k)
+        return [
+            [(int(idx), float(dist)) for idx, dist in zip(row_indices, row_distances) if idx >= 0]
+            for row_indices, row_distances in zip(indices, distances)
+        ]
+
+    def chunk(self, chunk_id):
+        """
+        Return:
+            (filename, start, end), 片段已被删除时返回 None
+        """
+        with self.swap_lock:
+            filenames, spans = self.filenames, self.spans
+        try:
+            pos = filenames.position(chunk_id)
+        except KeyError:
+            return None
+        return filenames[chunk_id], int(spans[pos][0]), int(spans[pos][1])
+
+    def file_chunks(self, filename):
+        """
+        某个文件的全部片段(按原文顺序), 不需要计算向量
+        Return:
+            [(filename, start, end, 0.0), ...]
+        """
+        entry = self.manifest["entries"].get(filename) or {}
+        chunks = [self.chunk(chunk_id) for chunk_id in entry.get("ids", [])]
+        chunks = sorted(chunk for chunk in chunks if chunk is not None)
+        if not chunks:  # 尚未建立索引, 使用整个文件
+            return [(filename, 0, np.iinfo('int64').max, 0.0)]
+        return [(*chunk, 0.0) for chunk in chunks]
+
+    def search_chunks_batch(self, queries, top_k=5):
+        """
+        批量搜索片段
+        Return:
+            [[(filename, start, end, distance), ...], ...]
+        """
+        results = []
+        for hits in self.search_ids_batch(queries, top_k=top_k):
+            chunks = [(self.chunk(chunk_id), dist) for chunk_id, dist in hits]
+            results.append([(*chunk, dist) for chunk, dist in chunks if chunk is not None])
+        return results
+
+    def search_chunks(self, query, top_k=5):
+        return self.search_chunks_batch([query], top_k=top_k)[0]
+
+    def search_batch(self, queries, top_k=5):
+        """
+        批量搜索文件: 多取一些片段, 每个文件保留得分最好的一个
+        Return:
+            [[(filname, distance), ...], ...]
+        """
+        results = []
+        for hits in self.search_chunks_batch(queries, top_k=top_k * 4):
+            files = {}
+            for filename, _, _, dist in hits:
+                files.setdefault(filename, dist)
+            results.append(list(files.items())[:top_k])
+        return results
+
     def search(self, query, top_k=5):
         """
         执行搜索
         Return:
             [(filname, distance), ...]
         """
-        query_vector = self.model.encode([query])
-        distances, indices = self.index.search(query_vector.astype('float32'), top_k)
-        
-        return [(self.filenames[idx], float(dist)) for idx, dist in zip(indices[0], distances[0])]
+        return self.search_batch([query], top_k=top_k)[0]
     
     def search_filename(self, query, topk=5):
         """
@@ -54,24 +388,53 @@ class FaissIndexer:
 
     def save_index(self, save_dir="index"):
         """
-        保存索引和文件名数据
+        保存索引、文件名表和增量构建清单(先写临时文件再替换)
         """
         if not os.path.exists(save_dir):
             os.makedirs(save_dir)
             
+        with self.swap_lock:
+            index, filenames, spans = self.index, self.filenames, self.spans
         # 保存Faiss索引
-        faiss.write_index(self.index, os.path.join(save_dir, "index.faiss"))
-        # 保存文件名列表
-        np.save(os.path.join(save_dir, "filenames.npy"), self.filenames)
+        path = os.path.join(save_dir, "index.faiss")
+        faiss.write_index(index, path + ".tmp")
+        os.replace(path + ".tmp", path)
+        # 保存片段所属文件名表 & 片段偏移
+        filenames.save(save_dir)
+        path = os.path.join(save_dir, "spans.npy")
+        with open(path + ".tmp", 'wb') as fout:
+            np.save(fout, spans)
+        os.replace(path + ".tmp", path)
+        # 清单最后写入
+        path = os.path.join(save_dir, "manifest.json")
+        with open(path + ".tmp", 'w', encoding='utf-8') as fout:
+            json.dump(self.manifest, fout, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
 
     def load_index(self, save_dir="index"):
         """
         加载已有索引
         """
         # 加载Faiss索引
-        self.index = faiss.read_index(os.path.join(save_dir, "index.faiss"))
-        # 加载文件名列表
-        self.filenames = np.load(os.path.join(save_dir, "filenames.npy"), allow_pickle=True)
+        index = faiss.read_index(os.path.join(save_dir, "index.faiss"))
+        set_search_params(index, self.nprobe, self.ef_search)
+        # 加载文件名表, 兼容旧的 filenames.npy
+        if StringTable.exists(save_dir):
+            filenames = StringTable.load(save_dir)
+        else:
+            filenames = StringTable.from_list(np.load(os.path.join(save_dir, "filenames.npy"), allow_pickle=True).tolist())
+        spans_path = os.path.join(save_dir, "spans.npy")
+        if os.path.exists(spans_path):
+            spans = np.load(spans_path)
+        else:
+            # 旧索引只有文件名, 片段视为整个文件
+            spans = np.tile(np.array([0, np.iinfo('int64').max], dtype='int64'), (len(filenames), 1))
+        with self.swap_lock:
+            self.index, self.filenames, self.spans = index, filenames, spans
+        manifest_path = os.path.join(save_dir, "manifest.json")
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r', encoding='utf-8') as fin:
+                self.manifest = json.load(fin)
     
 if __name__ == "__main__":
     # 读取目录下文件名
@@ -89,8 +452,9 @@ if __name__ == "__main__":
     # indexer.create_index(file_names)
     # indexer.save_index(save_dir="../index")
     
-    # 加载使用
+    # 加载使用, 并与 pre_info 增量同步
     indexer.load_index(save_dir="../index")
+    indexer.sync(pre_info_dir="../pre_info", save_dir="../index")
     query = "锐评一下 zhw 和 lzy "
     names = extract_name(query, name_set)
     print(names)  # ['zhw']
@@ -0,0 +1,158 @@
+import os
+import time
+import json
+import logging
+from threading import BoundedSemaphore
+
+import requests
+from requests.adapters import HTTPAdapter
+
+LOG = logging.getLogger("ApiClient")
+
+# 可重试的 HTTP 状态码: 限流 & 服务端错误
+_RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+class ApiError(Exception):
+    pass
+
+
+class ChatCompletionClient:
+    '''
+    OpenAI 兼容的 chat completions 客户端
+    - 复用连接池中的 keep-alive 连接
+    - SSE 流式返回
+    - 连接/读取超时, 失败重试(指数退避), 并发上限
+    '''
+    def __init__(self, base_url: str = "https://api.deepseek.com", api_key: str = None,
+                 model: str = "deepseek-reasoner", max_concurrency: int = 8,
+                 connect_timeout: float = 5, read_timeout: float = 60,
+                 max_retries: int = 3, backoff: float = 0.5, max_tokens: int = 2048,
+                 temperature: float = None):
+        self.base_url = base_url.rstrip('/')
+        self.url = self.base_url + "/chat/completions"
+        self.api_key = api_key or os.environ.get("DEEPSEEK_API_KEY", "")
+        self.model = model
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.semaphore = BoundedSemaphore(max_concurrency)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if self.api_key:
+            self.session.headers["Authorization"] = f"Bearer {self.api_key}"
+
+    def _post(self, messages: list) -> requests.Response:
+        '''
+        发送请求, 连接失败/超时/限流/服务端错误时按指数退避重试
+        '''
+        payload = {
+            "model": self.model,
+            # 只发送 role/content, 去掉本地附加的字段(如缓存的 token 数)
+            "messages": [{"role": m["role"], "content": m["content"]} for m in messages],
+            "stream": True,
+            "stream_options": {"include_usage": True},
+            "max_tokens": self.max_tokens,
+        }
+        if self.temperature is not None:
+            payload["temperature"] = self.temperature
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.session.post(self.url, json=payload, stream=True, timeout=self.timeout)
+                if response.status_code not in _RETRY_STATUS:
+                    response.raise_for_status()
+                    return response
+                response.close()
+                error = ApiError(f"HTTP {response.status_code}")
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            except requests.HTTPError as e:
+                response.close()  # 流式响应需要手动关闭, 连接才会回到连接池
+                raise ApiError(str(e)) from e
+            if attempt < self.max_retries:
+                wait = self.backoff * 2 ** attempt
+                LOG.warning(f"API 请求失败({error})，{wait:.1f}s 后重试 [{attempt + 1}/{self.max_retries}]")
+                time.sleep(wait)
+        raise ApiError(f"API 请求失败: {error}")
+
+    def stream(self, messages: list):
+        '''
+        流式生成, 逐段 yield 文本; reasoning_content 以 <think>...</think> 包裹, 与本地模型输出格式一致
+        Return:
+            {"response", "token_num", "token_speed", "cost_time", "ttft"}, ttft 为首段文本到达的时间
+        '''
+        end = time.time()
+        pieces = []
+        chunk_num = 0
+        token_num = None
+        first_token = None
+        thinking = False
+        with self.semaphore:
+            response = self._post(messages)
+            with response:
+                response.encoding = "utf-8"  # text/event-stream 未声明 charset 时 requests 默认按 latin-1 解码
+                for line in response.iter_lines(decode_unicode=True):
+                    if not line or not line.startswith("data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == "[DONE]":
+                        break
+                    chunk = json.loads(data)
+                    if chunk.get("usage"):
+                        token_num = chunk["usage"].get("completion_tokens", token_num)
+                    if not chunk.get("choices"):
+                        continue
+                    delta = chunk["choices"][0].get("delta") or {}
+                    text = ""
+                    if delta.get("reasoning_content"):
+                        text = delta["reasoning_content"] if thinking else "<think>\n" + delta["reasoning_content"]
+                        thinking = True
+                    if delta.get("content"):
+                        if thinking:
+                            text += "\n</think>\n\n"
+                            thinking = False
+                        text += delta["content"]
+                    if text:
+                        if first_token is None:
+                            first_token = time.time()
+                        chunk_num += 1
+                        pieces.append(text)
+                        yield text
+        if thinking:
+            pieces.append("\n</think>\n\n")
+            yield pieces[-1]
+        token_num = token_num if token_num is not None else chunk_num
+        cost_time = time.time() - end
+        return {
+            "response": "".join(pieces),
+            "token_num": token_num,
+            "token_speed": token_num / cost_time,
+            "cost_time": cost_time,
+            "ttft": first_token - end if first_token else None,
+        }
+
+    def ping(self) -> bool:
+        '''
+        健康检查: 请求 /models
+        '''
+        try:
+            response = self.session.get(self.base_url + "/models", timeout=self.timeout)
+            response.close()
+            return response.status_code < 500
+        except requests.RequestException:
+            return False
+
+    def chat(self, messages: list) -> dict:
+        '''
+        非流式调用(内部仍使用流式接口, 以便读取超时按块计算)
+        '''
+        chunks = self.stream(messages)
+        while True:
+            try:
+                next(chunks)
+            except StopIteration as e:
+                return e.value
@@ -0,0 +1,269 @@
+import time
+import logging
+from queue import Queue, Empty
+from threading import Thread, Event
+from concurrent.futures import Future
+
+import torch
+
+LOG = logging.getLogger("BatchScheduler")
+
+
+class GenerationRequest:
+    '''
+    一次生成请求(一个会话的一轮对话)
+    '''
+    def __init__(self, prompt_ids: list, max_new_tokens: int, think=None):
+        self.prompt_ids = prompt_ids
+        self.max_new_tokens = max_new_tokens
+        self.think = think  # ThinkBudget, 为空表示不限制思考长度
+        self.output_ids = []
+        self.future = Future()
+        self.submit_time = time.time()
+        self.first_token_time = None
+
+
+class TransformersBatchBackend:
+    '''
+    基于 transformers 的批处理后端
+    所有序列左填充(left padding)到同一长度，KV cache 以 legacy tuple 形式拼接/筛选，
+    从而在每个 decode step 都可以加入新序列或移除已完成的序列
+    '''
+    def __init__(self, model, tokenizer, do_sample: bool = True, temperature: float = 0.6):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.do_sample = do_sample
+        self.temperature = temperature
+        self.eos_token_id = tokenizer.eos_token_id
+        self.pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+
+    def tokenize(self, messages: list) -> list:
+        text = self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        return self.tokenizer(text)["input_ids"]
+
+    def detokenize(self, ids: list) -> str:
+        return self.tokenizer.decode(ids, skip_special_tokens=True)
+
+    def _sample(self, logits) -> list:
+        if self.do_sample:
+            probs = torch.softmax(logits.float() / self.temperature, dim=-1)
+            next_tokens = torch.multinomial(probs, num_samples=1).squeeze(-1)
+        else:
+            next_tokens = torch.argmax(logits, dim=-1)
+        return next_tokens.tolist()
+
+    @staticmethod
+    def _to_legacy(past_key_values):
+        if hasattr(past_key_values, "to_legacy_cache"):
+            return past_key_values.to_legacy_cache()
+        return past_key_values
+
+    @staticmethod
+    def _from_legacy(past_key_values):
+        from transformers import DynamicCache
+        return DynamicCache.from_legacy_cache(past_key_values)
+
+    @torch.no_grad()
+    def prefill(self, prompts: list):
+        '''
+        对新加入的序列做 prefill
+        Return:
+            (state, next_tokens)
+        '''
+        max_len = max(len(p) for p in prompts)
+        input_ids = torch.full((len(prompts), max_len), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(prompts), max_len), dtype=torch.long)
+        for i, prompt in enumerate(prompts):
+            input_ids[i, max_len - len(prompt):] = torch.tensor(prompt, dtype=torch.long)
+            attention_mask[i, max_len - len(prompt):] = 1
+        input_ids = input_ids.to(self.model.device)
+        attention_mask = attention_mask.to(self.model.device)
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            use_cache=True,
+        )
+        state = {"past": self._to_legacy(outputs.past_key_values), "mask": attention_mask}
+        return state, self._sample(outputs.logits[:, -1, :])
+
+    @torch.no_grad()
+    def step(self, state: dict, tokens: list):
+        '''
+        对当前批次做一次 decode
+        '''
+        mask = state["mask"]
+        mask = torch.cat([mask, mask.new_ones((mask.shape[0], 1))], dim=-1)
+        input_ids = torch.tensor(tokens, dtype=torch.long, device=mask.device).unsqueeze(-1)
+        position_ids = mask.sum(-1, keepdim=True) - 1
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=mask,
+            position_ids=position_ids,
+            past_key_values=self._from_legacy(state["past"]),
+            use_cache=True,
+        )
+        state = {"past": self._to_legacy(outputs.past_key_values), "mask": mask}
+        return state, self._sample(outputs.logits[:, -1, :])
+
+    @staticmethod
+    def _left_pad(tensor, length: int, dim: int):
+        pad = length - tensor.shape[dim]
+        if pad <= 0:
+            return tensor
+        shape = list(tensor.shape)
+        shape[dim] = pad
+        return torch.cat([tensor.new_zeros(shape), tensor], dim=dim)
+
+    def concat(self, state_a: dict, state_b: dict) -> dict:
+        '''
+        合并两个批次(左填充到相同长度)
+        '''
+        length = max(state_a["mask"].shape[1], state_b["mask"].shape[1])
+        past = []
+        for (k_a, v_a), (k_b, v_b) in zip(state_a["past"], state_b["past"]):
+            # k/v: (batch, heads, seq_len, head_dim)
+            past.append((
+                torch.cat([self._left_pad(k_a, length, 2), self._left_pad(k_b, length, 2)], dim=0),
+                torch.cat([self._left_pad(v_a, length, 2), self._left_pad(v_b, length, 2)], dim=0),
+            ))
+        mask = torch.cat([self._left_pad(state_a["mask"], length, 1), self._left_pad(state_b["mask"], length, 1)], dim=0)
+        return {"past": tuple(past), "mask": mask}
+
+    def filter(self, state: dict, keep: list) -> dict:
+        '''
+        保留 keep 中的序列，并裁掉所有序列共有的左侧填充
+        '''
+        index = torch.tensor(keep, dtype=torch.long, device=state["mask"].device)
+        mask = state["mask"].index_select(0, index)
+        start = int(mask.sum(0).nonzero()[0])
+        past = tuple(
+            (k.index_select(0, index)[:, :, start:], v.index_select(0, index)[:, :, start:])
+            for k, v in state["past"]
+        )
+        return {"past": past, "mask": mask[:, start:]}
+
+
+class BatchScheduler:
+    '''
+    连续批处理调度器
+    各会话线程通过 submit 提交请求，调度线程在每个 decode step 之间
+    加入新请求、移除已完成请求，并把结果回传给对应的调用方
+    '''
+    def __init__(self, backend, max_batch_size: int = 8, max_new_tokens: int = 2048, max_wait: float = 0.01,
+                 think=None):
+        '''
+        Args:
+            think: ThinkTokens, 为空表示不限制思考长度
+        '''
+        self.backend = backend
+        self.think = think
+        self.max_batch_size = max_batch_size
+        self.max_new_tokens = max_new_tokens
+        self.max_wait = max_wait  # 空闲时等待凑批的时间(s)
+        self.queue = Queue()
+        self._stop = Event()
+        self._thread = None
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = Thread(target=self._loop, name="BatchScheduler", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, messages: list, max_new_tokens: int = None) -> Future:
+        '''
+        提交一个会话的历史记录，返回 Future，结果格式与 DeepSeek.generate 一致
+        '''
+        prompt_ids = self.backend.tokenize(messages)
+        think = self.think.start(prompt_ids) if self.think is not None else None
+        request = GenerationRequest(prompt_ids, max_new_tokens or self.max_new_tokens, think)
+        self.queue.put(request)
+        return request.future
+
+    def generate(self, messages: list, max_new_tokens: int = None) -> dict:
+        return self.submit(messages, max_new_tokens).result()
+
+    def _collect(self, free: int, block: bool) -> list:
+        '''
+        从等待队列中取出至多 free 个请求
+        '''
+        requests = []
+        if free <= 0:
+            return requests
+        try:
+            if block:
+                requests.append(self.queue.get(timeout=0.1))
+                deadline = time.time() + self.max_wait
+            else:
+                deadline = time.time()
+            while len(requests) < free:
+                remaining = deadline - time.time()
+                if remaining > 0:
+                    requests.append(self.queue.get(timeout=remaining))
+                else:
+                    requests.append(self.queue.get_nowait())
+        except Empty:
+            pass
+        return requests
+
+    def _finish(self, request: GenerationRequest) -> None:
+        cost_time = time.time() - request.submit_time
+        token_num = len(request.output_ids)
+        request.future.set_result({
+            "response": self.backend.detokenize(request.output_ids),
+            "token_num": token_num,
+            "token_speed": token_num / cost_time,
+            "cost_time": cost_time,
+            "ttft": request.first_token_time - request.submit_time,
+        })
+
+    def _loop(self) -> None:
+        state, active, pending = None, [], []
+        while not self._stop.is_set():
+            new_requests = []
+            try:
+                # 加入新请求
+                new_requests = self._collect(self.max_batch_size - len(active), block=not active)
+                if new_requests:
+                    new_state, new_tokens = self.backend.prefill([r.prompt_ids for r in new_requests])
+                    state = new_state if state is None else self.backend.concat(state, new_state)
+                    active += new_requests
+                    pending += new_tokens
+                if not active:
+                    continue
+
+                # 记录本步生成的 token，移除已完成的请求
+                keep = []
+                for i, (request, token) in enumerate(zip(active, pending)):
+                    if request.think is not None:  # 超出思考预算时替换为 </think>
+                        forced = request.think.force()
+                        token = forced if forced is not None else token
+                        request.think.update(token)
+                    if not request.output_ids:
+                        request.first_token_time = time.time()
+                    request.output_ids.append(token)
+                    if token == self.backend.eos_token_id or len(request.output_ids) >= request.max_new_tokens:
+                        self._finish(request)
+                    else:
+                        keep.append(i)
+                if len(keep) < len(active):
+                    state = self.backend.filter(state, keep) if keep else None
+                    active = [active[i] for i in keep]
+                if not active:
+                    pending = []
+                    continue
+
+                state, pending = self.backend.step(state, [r.output_ids[-1] for r in active])
+            except Exception as e:
+                LOG.error(f"Batch generation error: {e}")
+                for request in active + new_requests:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                state, active, pending = None, [], []
@@ -1,18 +1,23 @@
 import os
 import sys
 from pathlib import Path
-from itertools import chain
 root_dir = Path(__file__).parent.parent
 sys.path.append(str(root_dir))
 
 import time
+import logging
 import torch
 import yaml
-from utils.utils import load_sys_prompt, load_model_config
-from wcferry import Wcf
+from utils.utils import load_sys_prompt, load_model_config, estimate_tokens
+from model.batching import BatchScheduler, TransformersBatchBackend
+from model.kv_cache import KVCacheManager, common_prefix_len
+from model.prompt_cache import PromptTokenCache, ChatTemplateCache
+from model.think_budget import ThinkTokens, ThinkBudgetProcessor
+from model.api_client import ChatCompletionClient
+from utils.metrics import metrics
 from typing import Optional
-from vllm import LLM, SamplingParams
-from transformers import AutoModelForCausalLM, AutoTokenizer, TextStreamer
+from threading import Thread, Lock
+from transformers import AutoModelForCausalLM, AutoTokenizer, TextStreamer, TextIteratorStreamer, DynamicCache, LogitsProcessorList
 
 _model_root = "C:\Projects\DeepSeek"
 _model_options = (
@@ -22,6 +27,52 @@ _model_options = (
     "DeepSeek-R1-Distill-Qwen-14B",
     "QwQ-32B",
 )
+# 每条消息除内容外, 对话模板引入的角色标记等额外 token 数(估计值)
+_MESSAGE_OVERHEAD = 4
+
+LOG = logging.getLogger("DeepSeek")
+
+def cpu_supports_bf16() -> bool:
+    '''
+    CPU 是否有原生 bf16 指令(AVX512-BF16 / AMX), 没有时 bf16 计算反而比 fp32 慢
+    '''
+    for check in ("_is_amx_tile_supported", "_is_avx512_bf16_supported"):
+        func = getattr(torch.cpu, check, None)
+        if func is not None and func():
+            return True
+    return False
+
+class GenerationStream:
+    '''
+    流式生成结果: 迭代得到文本片段, 迭代结束后 outputs 为与 generate 相同格式的统计信息
+    '''
+    def __init__(self, chunks, thinking: bool = False):
+        self._chunks = chunks
+        self.thinking = thinking  # prompt 是否已打开 <think>, 此时输出从思考内容开始, 不含 <think>
+        self.outputs = None
+
+    def __iter__(self):
+        self.outputs = yield from self._chunks
+
+class FirstTokenTimer:
+    '''
+    包装 streamer, 记录第一个生成 token 的时间(generate 第一次 put 的是 prompt)
+    '''
+    def __init__(self, streamer=None):
+        self.streamer = streamer
+        self.puts = 0
+        self.first_token = None
+
+    def put(self, value):
+        self.puts += 1
+        if self.puts == 2:
+            self.first_token = time.time()
+        if self.streamer is not None:
+            self.streamer.put(value)
+
+    def end(self):
+        if self.streamer is not None:
+            self.streamer.end()
 
 class DeepSeek:
     def __init__(self, config: dict, ):
@@ -35,8 +86,22 @@ class DeepSeek:
         self.role = config.get('role', 'default')
         self.sys_prompt = load_sys_prompt(self.role)
         self.default_messages = [{"role": "system", "content": self.sys_prompt}]
-        # 历史记录长度
-        self.history = config.get('history', 3)
+        # 上下文 token 预算: 历史记录 + 本轮输入不超过 max_context_tokens - max_new_tokens
+        context = config.get('context', None) or {}
+        self.max_context_tokens = context.get('max_context_tokens', 8192)
+        self.max_new_tokens = context.get('max_new_tokens', 2048)
+        # 思考部分最多生成的 token 数, 超出时强制结束思考, 0 表示不限制
+        self.think_budget = context.get('think_budget', 0)
+        self.think = None
+        # 对话模板的生成提示是否以 <think> 结尾(R1 系列), 此时生成的文本不含 <think>, 直接从思考内容开始
+        self.prompt_think = False
+        self.prompt_cache = None
+        self.template_cache = None
+        # 本地模型同一时间只执行一个 generate, 多个工作线程同时生成会争抢显存
+        self.generate_lock = Lock()
+        # 跨轮次 KV cache 复用
+        kv_cache = config.get('kv_cache', None) or {}
+        self.kv_cache = KVCacheManager(kv_cache.get('max_memory_mb', 2048)) if kv_cache.get('enable', False) else None
         # 初始化模型
         self._initialize_local(config) if self.mode == 'local' else self._initialize_api(config)
     
@@ -44,108 +109,339 @@ class DeepSeek:
         '''
             本地部署初始化
         '''
+        self.device = config.get('device', 'cuda')  # options: {cuda, cpu}
+        assert self.device in ('cuda', 'cpu'), f"config.device shoule be in ('cuda', 'cpu'), but got {self.device}"
+        model_name = config.get('model_name', None)
         if self.frame == "transformers":
-            model_name = config.get('model_name', None)
-            model_path = os.path.join(_model_root, model_name)
-            self.model = AutoModelForCausalLM.from_pretrained(
-                model_path,
-                torch_dtype="auto",
-                device_map="cuda:0",
-                # llm_int8_enable_fp32_cpu_offload=True,
-                low_cpu_mem_usage=True,
-                # use_flash_attention_2=True,
-                attn_implementation="flash_attention_2",
-                quantization_config={
-                    "load_in_4bit": True,  # 4-bit量化
-                    "bnb_4bit_compute_dtype": torch.float16
-                }
-            )
-            self.model = torch.compile(self.model)  # dynamic graph compile (improve not much)
+            model_path = config.get('model_path', None) or os.path.join(_model_root, model_name)
+            if self.device == "cuda":
+                self._load_cuda(model_path)
+            else:
+                self._load_cpu(model_path, config.get('cpu', None) or {})
             self.tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
-            self.streamer = TextStreamer(self.tokenizer)
+            self.prompt_cache = PromptTokenCache(self.tokenizer)
+            self.template_cache = ChatTemplateCache(self.tokenizer)
+            prompt = self.tokenizer.apply_chat_template(
+                [{"role": "user", "content": "hi"}], tokenize=False, add_generation_prompt=True)
+            self.prompt_think = prompt.rstrip().endswith("<think>")
+            if self.think_budget:
+                self.think = ThinkTokens(self.tokenizer, self.think_budget)
         else:
             # TODO add vllm frame, on Mac or Linux
+            from vllm import LLM, SamplingParams  # 只在使用 vllm 时导入
             model = LLM(model=model_name, tensor_parallel_size=1)
             sampling_params = SamplingParams(
                 max_tokens=512,
                 temperature=0
             )
         self.generate_mode = self.frame
+
+        # 连续批处理: 多个会话的请求合并为一个 batch 生成
+        batching = config.get('batching', None) or {}
+        if self.frame == "transformers" and batching.get('enable', False):
+            backend = TransformersBatchBackend(self.model, self.tokenizer, do_sample=True)
+            self.scheduler = BatchScheduler(
+                backend,
+                max_batch_size=batching.get('max_batch_size', 8),
+                max_new_tokens=batching.get('max_new_tokens', self.max_new_tokens),
+                max_wait=batching.get('max_wait', 0.01),
+                think=self.think,
+            )
+            self.scheduler.start()
+            self.generate_mode = "batch"
     
+    def _load_cuda(self, model_path: str):
+        self.model = AutoModelForCausalLM.from_pretrained(
+            model_path,
+            torch_dtype="auto",
+            device_map="cuda:0",
+            # llm_int8_enable_fp32_cpu_offload=True,
+            low_cpu_mem_usage=True,
+            # use_flash_attention_2=True,
+            attn_implementation="flash_attention_2",
+            quantization_config={
+                "load_in_4bit": True,  # 4-bit量化
+                "bnb_4bit_compute_dtype": torch.float16
+            }
+        )
+        self.model = torch.compile(self.model)  # dynamic graph compile (improve not much)
+        self.autocast = True
+
+    def _load_cpu(self, model_path: str, cpu: dict):
+        '''
+        CPU 推理: Linear 层 int8 动态量化, 或在支持 bf16 的 CPU 上使用 bf16 权重
+        '''
+        if cpu.get('num_threads', 0):
+            torch.set_num_threads(cpu['num_threads'])  # 算子内并行线程数, 默认等于物理核数
+        if cpu.get('num_interop_threads', 0):
+            try:
+                torch.set_num_interop_threads(cpu['num_interop_threads'])
+            except RuntimeError as e:  # 已有并行任务运行后不能再修改
+                LOG.warning(f"设置 interop 线程数失败: {e}")
+        quantize = cpu.get('quantize', True)
+        dtype = cpu.get('dtype', 'auto')
+        if quantize:
+            dtype = torch.float32  # 动态量化只支持 fp32 权重, 激活在计算时量化
+        elif dtype == 'auto':
+            dtype = torch.bfloat16 if cpu_supports_bf16() else torch.float32
+        else:
+            dtype = getattr(torch, dtype)
+        self.model = AutoModelForCausalLM.from_pretrained(
+            model_path,
+            torch_dtype=dtype,
+            device_map="cpu",
+            low_cpu_mem_usage=True,
+        )
+        self.model.eval()
+        if quantize:
+            self.model = torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+        if cpu.get('compile', False):
+            # 编译结果缓存到磁盘, 重启后不需要重新编译
+            cache_dir = cpu.get('compile_cache_dir', 'data/torch_compile_cache')
+            os.makedirs(cache_dir, exist_ok=True)
+            os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.abspath(cache_dir))
+            os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+            # 只编译 forward, generate 中每个 decode step 都走编译后的图
+            self.model.forward = torch.compile(self.model.forward, dynamic=True)
+        self.autocast = False
+        LOG.info(f"CPU 推理: dtype={dtype}, int8 量化={quantize}, 线程数={torch.get_num_threads()}, compile={cpu.get('compile', False)}")
+
     def _initialize_api(self, config):
         '''
-            使用api初始化
+            使用api初始化 (OpenAI 兼容接口)
         '''
-        # TODO
+        self.client = ChatCompletionClient(**(config.get('api', None) or {}))
         self.generate_mode = "api"
-        pass
 
-    def clean_history_messages(self, messages: list, history: int=3) -> list:
+    def count_tokens(self, message: dict) -> int:
+        '''
+        单条消息的 token 数, 计算一次后缓存在消息的 "_tokens" 字段中(内容变化时重新计算)
+        '''
+        content = message.get("content") or ""
+        cached = message.get("_tokens")
+        if cached is not None and cached[0] == hash(content):
+            return cached[1]
+        if self.mode == 'local' and self.frame == 'transformers':
+            num = len(self.tokenizer.encode(content, add_special_tokens=False))
+        else:
+            num = estimate_tokens(content)
+        num += _MESSAGE_OVERHEAD
+        message["_tokens"] = (hash(content), num)
+        return num
+
+    def clean_history_messages(self, messages: list, history: int=None, key=None, reserve: int=0) -> list:
         '''
-        清除历史记录
+        清除历史记录: 从最近一轮往前保留, 总 token 数不超过 max_context_tokens - max_new_tokens
         Args:
             messages: list, {{"role": "system", "content": self.sys_prompt}, ...}
+            history: 最多保留的轮数, None 表示只按 token 预算裁剪, 0 表示清空
+            key: 会话标识, 历史记录被裁剪时同时丢弃该会话的 KV cache
+            reserve: 为本轮临时注入的内容(如检索到的资料)预留的 token 数
         '''
+        system = {"role": "system", "content": self.sys_prompt}
+        if history != 0:
+            body = messages[1:] if messages and messages[0]["role"] == "system" else messages
+            budget = self.max_context_tokens - self.max_new_tokens - reserve
+            used = self.count_tokens(messages[0] if len(body) < len(messages) else system)
+            keep = 0
+            for message in reversed(body):
+                used += self.count_tokens(message)
+                if used > budget and keep > 0:  # 至少保留最新一条
+                    break
+                keep += 1
+            if history is not None:
+                keep = min(keep, 2 * history)
+            # 保留的历史从用户消息开始
+            while keep > 1 and body[len(body) - keep]["role"] != "user":
+                keep -= 1
+            if keep == len(body):
+                return messages
+        if self.kv_cache is not None and key is not None:
+            self.kv_cache.drop(("conv", key))
         if history == 0:
-            return [{"role": "system", "content": self.sys_prompt}]
-        elif len(messages) <= 2 * history + 1:
-            return messages
-        else:
-            return list(chain([{"role": "system", "content": self.sys_prompt}], messages[-2 * history:]))
+            if self.prompt_cache is not None and key is not None:
+                self.prompt_cache.drop(key)
+                self.template_cache.drop(key)
+            return [system]
+        return [system] + body[len(body) - keep:]
+
+    def _encode(self, messages: list, add_generation_prompt: bool=True, key=None):
+        '''
+        key 不为空时复用该会话上一轮的模板渲染和分词结果, 只对新增部分渲染、分词
+        '''
+        text = self.template_cache.render(messages, add_generation_prompt=add_generation_prompt, key=key)
+        input_ids = torch.tensor([self.prompt_cache.encode(text, key=key)], device=self.model.device)
+        return {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+
+    def _prefix_cache(self):
+        '''
+        当前角色系统提示词的共享前缀缓存, 被淘汰后按需重建
+        '''
+        entry = self.kv_cache.get(("prefix", self.role))
+        if entry is None:
+            input_ids = self._encode(self.default_messages, add_generation_prompt=False)["input_ids"]
+            with torch.no_grad():
+                outputs = self.model(input_ids=input_ids, use_cache=True)
+            past_key_values = outputs.past_key_values
+            if hasattr(past_key_values, "to_legacy_cache"):
+                past_key_values = past_key_values.to_legacy_cache()
+            entry = self.kv_cache.put(("prefix", self.role), input_ids[0].tolist(), past_key_values)
+        return entry
+
+    def _reuse_cache(self, input_ids: list, key=None):
+        '''
+        从会话缓存或系统提示词缓存中找到与本轮输入最长公共前缀的 KV cache,
+        裁剪到公共前缀长度, 本轮只需 prefill 剩余部分
+        '''
+        candidates = [self._prefix_cache()]
+        if key is not None:
+            candidates.append(self.kv_cache.get(("conv", key)))
+        best, best_len = None, 0
+        for entry in candidates:
+            if entry is None:
+                continue
+            n = common_prefix_len(entry.token_ids, input_ids)
+            if n > best_len:
+                best, best_len = entry, n
+        # 至少保留一个 token 用于计算本轮第一个输出
+        best_len = min(best_len, len(input_ids) - 1)
+        if best is None or best_len <= 0:
+            return None
+        cache = DynamicCache.from_legacy_cache(best.past_key_values)
+        cache.crop(best_len)
+        return cache
 
-    def generate_tfs(self, messages: list):
+    def generate_tfs(self, messages: list, key=None, streamer=None):
         end = time.time()
-        # self.messages.append({"role": "user", "content": input_txt})
-        # self.clean_history_messages(self.history)
-        text = self.tokenizer.apply_chat_template(
-            messages,
-            tokenize=False,
-            add_generation_prompt=True
-        )
-        model_inputs = self.tokenizer([text], return_tensors="pt").to(self.model.device)
-        with torch.amp.autocast("cuda", enabled=True):
-            generated_ids = self.model.generate(
-                **model_inputs,
-                max_new_tokens=2048,
-                # load_in_4bit=True,                        # 4-bit量化
-                num_beams=1,                                # 禁用束搜索
-                do_sample=True,                            # 禁用采样
-                use_cache=True,                             # 启用KV缓存
-                pad_token_id=self.tokenizer.pad_token_id,   # 配置padding_id
-                eos_token_id=self.tokenizer.eos_token_id,   # 配置eos_id
-                streamer = self.streamer,                   # 流式输出
-            )
-            generated_ids = [
-                output_ids[len(input_ids):] for input_ids, output_ids in zip(model_inputs.input_ids, generated_ids)
-            ]
-            token_num = len(generated_ids[0])
-            cost_time = time.time() - end
-            token_speed = token_num / cost_time
-
-            response = self.tokenizer.batch_decode(generated_ids, skip_special_tokens=True)[0]
-            # self.messages.append({"role": "assistant", "content": response})
+        with metrics.stage("tokenize"):
+            model_inputs = self._encode(messages, key=key)
+        # 每次调用使用独立的 streamer, TextStreamer 内部有逐次生成的状态
+        timer = FirstTokenTimer(streamer or TextStreamer(self.tokenizer))
+        logits_processor = None
+        if self.think is not None:
+            prompt_ids = model_inputs["input_ids"][0].tolist()
+            logits_processor = LogitsProcessorList([ThinkBudgetProcessor([self.think.start(prompt_ids)], len(prompt_ids))])
+        with self.generate_lock:
+            past_key_values = None
+            if self.kv_cache is not None:
+                past_key_values = self._reuse_cache(model_inputs["input_ids"][0].tolist(), key)
+            with torch.amp.autocast(self.device, enabled=self.autocast):
+                outputs = self.model.generate(
+                    **model_inputs,
+                    past_key_values=past_key_values,            # 复用的KV缓存
+                    return_dict_in_generate=True,
+                    max_new_tokens=self.max_new_tokens,
+                    logits_processor=logits_processor,          # 思考预算
+                    # load_in_4bit=True,                        # 4-bit量化
+                    num_beams=1,                                # 禁用束搜索
+                    do_sample=True,                            # 禁用采样
+                    use_cache=True,                             # 启用KV缓存
+                    pad_token_id=self.tokenizer.pad_token_id,   # 配置padding_id
+                    eos_token_id=self.tokenizer.eos_token_id,   # 配置eos_id
+                    streamer = timer,                           # 流式输出, 同时记录首 token 时间
+                )
+                generated_ids = [
+                    output_ids[len(input_ids):] for input_ids, output_ids in zip(model_inputs["input_ids"], outputs.sequences)
+                ]
+                token_num = len(generated_ids[0])
+                cost_time = time.time() - end
+                token_speed = token_num / cost_time
+
+                response = self.tokenizer.batch_decode(generated_ids, skip_special_tokens=True)[0]
+                # self.messages.append({"role": "assistant", "content": response})
+            if self.kv_cache is not None and key is not None:
+                cache = outputs.past_key_values
+                token_ids = outputs.sequences[0].tolist()[:cache.get_seq_length()]
+                self.kv_cache.put(("conv", key), token_ids, cache.to_legacy_cache())
         return {
             "response": response,
             "token_num": token_num,
             "token_speed": token_speed,
             "cost_time": cost_time,
+            "ttft": timer.first_token - end if timer.first_token else None,
+            "thinking": self.prompt_think,
         }
 
-    def generate_vllm(self, messages: list):
+    def generate_tfs_stream(self, messages: list, key=None):
+        '''
+        在后台线程中生成, 通过 TextIteratorStreamer 逐段返回文本
+        '''
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        result = {}
+
+        def run():
+            try:
+                result['outputs'] = self.generate_tfs(messages, key=key, streamer=streamer)
+            except Exception as e:
+                result['error'] = e
+                streamer.end()
+
+        thread = Thread(target=run, name="GenerateStream", daemon=True)
+        thread.start()
+        for text in streamer:
+            if text:
+                yield text
+        thread.join()
+        if 'error' in result:
+            raise result['error']
+        return result['outputs']
+
+    def generate_batch(self, messages: list, key=None):
+        '''
+        提交到批处理调度器，阻塞直到本请求生成完毕
+        '''
+        outputs = self.scheduler.generate(messages)
+        outputs['thinking'] = self.prompt_think
+        return outputs
+
+    def generate_vllm(self, messages: list, key=None):
         # TODO
         pass
     
-    def generate_api(self, messages: list):
-        # TODO
-        pass
+    def generate_api(self, messages: list, key=None):
+        return self.client.chat(messages)
 
-    def generate(self, messages: list):
+    def generate(self, messages: list, key=None):
+        '''
+        Args:
+            messages: 对话历史
+            key: 会话标识(如 sender), 用于复用该会话的 KV cache
+        '''
         generate_mode = {
             "transformers": self.generate_tfs,
+            "batch": self.generate_batch,
             "vllm": self.generate_vllm,
             "api": self.generate_api,
         }
-        return generate_mode[self.generate_mode](messages)
+        return generate_mode[self.generate_mode](messages, key=key)
+
+    def ping(self) -> bool:
+        '''
+        健康检查, 本地模型总是可用
+        '''
+        if self.generate_mode == "api":
+            return self.client.ping()
+        return True
+
+    def _generate_once(self, messages: list, key=None):
+        '''
+        不支持流式的生成方式: 整段生成后一次性返回
+        '''
+        outputs = self.generate(messages, key=key)
+        yield outputs['response']
+        return outputs
+
+    def generate_stream(self, messages: list, key=None) -> GenerationStream:
+        '''
+        流式生成
+        Return:
+            GenerationStream, 迭代得到文本片段, 结束后通过 .outputs 获取统计信息
+        '''
+        if self.generate_mode == "transformers":
+            return GenerationStream(self.generate_tfs_stream(messages, key=key), thinking=self.prompt_think)
+        if self.generate_mode == "api":
+            return GenerationStream(self.client.stream(messages))
+        return GenerationStream(self._generate_once(messages, key=key))
 
 if __name__ == "__main__":
     configs = load_model_config(model="deepseek")
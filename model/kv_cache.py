@@ -0,0 +1,68 @@
+import logging
+from threading import Lock
+from collections import OrderedDict
+
+LOG = logging.getLogger("KVCache")
+
+
+def common_prefix_len(a: list, b: list) -> int:
+    '''
+    两个 token 序列的最长公共前缀长度
+    '''
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+
+class CacheEntry:
+    def __init__(self, token_ids: list, past_key_values: tuple):
+        self.token_ids = token_ids
+        # legacy 格式: ((key, value), ...) 每层一个, key/value: (batch, heads, seq_len, head_dim)
+        self.past_key_values = past_key_values
+        self.nbytes = sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in past_key_values)
+
+
+class KVCacheManager:
+    '''
+    KV cache 管理
+    key: ("conv", sender) 会话缓存 | ("prefix", role) 系统提示词共享前缀缓存
+    所有缓存共享一个显存预算，超出时按 LRU 淘汰
+    '''
+    def __init__(self, max_memory_mb: float = 2048):
+        self.max_bytes = int(max_memory_mb * 1024 * 1024)
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = Lock()
+
+    def get(self, key) -> CacheEntry:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, token_ids: list, past_key_values: tuple) -> CacheEntry:
+        entry = CacheEntry(token_ids, past_key_values)
+        with self.lock:
+            self._pop(key)
+            if entry.nbytes > self.max_bytes:
+                LOG.info(f"KV cache {key} 超出预算 ({entry.nbytes} bytes)，不缓存")
+                return entry
+            self.entries[key] = entry
+            self.total_bytes += entry.nbytes
+            while self.total_bytes > self.max_bytes:
+                old_key, _ = next(iter(self.entries.items()))
+                self._pop(old_key)
+                LOG.info(f"KV cache 淘汰: {old_key}")
+        return entry
+
+    def drop(self, key) -> None:
+        with self.lock:
+            self._pop(key)
+
+    def _pop(self, key) -> None:
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry.nbytes
@@ -0,0 +1,138 @@
+from threading import Lock
+from collections import OrderedDict
+
+from model.kv_cache import common_prefix_len
+
+
+class PromptTokenCache:
+    '''
+    会话级的 prompt 分词缓存
+    多轮对话中新 prompt 与上一轮 prompt 的文本通常只在末尾不同,
+    在特殊 token(如 <｜User｜>, <｜Assistant｜>)处切分, 前缀直接复用上一轮的 token ids,
+    只对剩余文本分词; 特殊 token 前后的分词互不影响, 结果与整段分词一致
+    '''
+    def __init__(self, tokenizer, max_entries: int = 256):
+        self.tokenizer = tokenizer
+        self.max_entries = max_entries
+        self.special_ids = set(tokenizer.all_special_ids) | set(getattr(tokenizer, "added_tokens_decoder", {}))
+        self.entries = OrderedDict()  # {key: (text, token_ids, boundaries)}
+        self.lock = Lock()
+
+    def _tokenize(self, text: str, offset: int, add_special_tokens: bool):
+        '''
+        Return:
+            token_ids, [(字符位置, token 位置), ...] 每个特殊 token 的起点
+        '''
+        encoding = self.tokenizer(text, add_special_tokens=add_special_tokens, return_offsets_mapping=True)
+        token_ids = encoding["input_ids"]
+        boundaries = [
+            (offset + start, pos) for pos, (token_id, (start, end)) in enumerate(zip(token_ids, encoding["offset_mapping"]))
+            if token_id in self.special_ids and end > start
+        ]
+        return token_ids, boundaries
+
+    def encode(self, text: str, key=None) -> list:
+        if key is None:
+            return self.tokenizer(text)["input_ids"]
+        with self.lock:
+            entry = self.entries.get(key)
+        cut = None
+        if entry is not None:
+            n = common_prefix_len(entry[0], text)
+            # 在起点不超过公共前缀的最后一个特殊 token 处切分
+            for char_pos, token_pos in reversed(entry[2]):
+                if char_pos <= n and token_pos > 0:
+                    cut = (char_pos, token_pos)
+                    break
+        if cut is None:
+            token_ids, boundaries = self._tokenize(text, 0, add_special_tokens=True)
+        else:
+            char_pos, token_pos = cut
+            suffix_ids, suffix_boundaries = self._tokenize(text[char_pos:], char_pos, add_special_tokens=False)
+            token_ids = entry[1][:token_pos] + suffix_ids
+            boundaries = [b for b in entry[2] if b[1] < token_pos]
+            boundaries += [(c, p + token_pos) for c, p in suffix_boundaries]
+        with self.lock:
+            self.entries[key] = (text, token_ids, boundaries)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return token_ids
+
+    def drop(self, key) -> None:
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+class ChatTemplateCache:
+    '''
+    会话级的对话模板渲染缓存
+    缓存每个会话上一轮已渲染的文本(不含生成提示), 新一轮的消息以上一轮为前缀时只渲染新增的消息;
+    只对"逐条消息拼接"的模板生效(初始化时用示例对话检查), 否则每次完整渲染
+    '''
+    def __init__(self, tokenizer, max_entries: int = 256):
+        self.tokenizer = tokenizer
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # {key: (((role, content), ...), text)}
+        self.headers = {}  # {系统提示词: 只含系统提示词的渲染结果}
+        self.generation_suffix = ""
+        self.lock = Lock()
+        self.incremental = self._check()
+
+    def _render(self, messages: list, add_generation_prompt: bool = False) -> str:
+        return self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=add_generation_prompt)
+
+    def _delta(self, system: dict, messages: list) -> str:
+        '''
+        messages 接在系统提示词之后的渲染结果
+        '''
+        header = self.headers.get(system["content"])
+        if header is None:
+            header = self.headers[system["content"]] = self._render([system])
+        text = self._render([system] + messages)
+        if not text.startswith(header):
+            raise ValueError("chat template is not incremental")
+        return text[len(header):]
+
+    def _check(self) -> bool:
+        system = {"role": "system", "content": "s"}
+        probe = [
+            system,
+            {"role": "user", "content": "u1"},
+            {"role": "assistant", "content": "<think>\nt\n</think>\n\na1"},
+            {"role": "user", "content": "u2"},
+        ]
+        try:
+            full = self._render(probe)
+            if full != self._render([system]) + self._delta(system, probe[1:2]) + self._delta(system, probe[2:]):
+                return False
+            prompt = self._render(probe, add_generation_prompt=True)
+        except Exception:
+            return False
+        finally:
+            self.headers.clear()
+        self.generation_suffix = prompt[len(full):]
+        return prompt.startswith(full)
+
+    def render(self, messages: list, add_generation_prompt: bool = True, key=None) -> str:
+        messages = [{"role": m["role"], "content": m["content"]} for m in messages]
+        if not self.incremental or key is None or not messages or messages[0]["role"] != "system":
+            return self._render(messages, add_generation_prompt)
+        snapshot = tuple((m["role"], m["content"]) for m in messages)
+        with self.lock:
+            entry = self.entries.get(key)
+        n = len(entry[0]) if entry is not None else 0
+        if n and snapshot[:n] == entry[0]:
+            text = entry[1] + (self._delta(messages[0], messages[n:]) if n < len(snapshot) else "")
+        else:  # 第一轮或历史被裁剪/清空
+            text = self._render(messages)
+        with self.lock:
+            self.entries[key] = (snapshot, text)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return text + self.generation_suffix if add_generation_prompt else text
+
+    def drop(self, key) -> None:
+        with self.lock:
+            self.entries.pop(key, None)
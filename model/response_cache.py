@@ -0,0 +1,181 @@
+import time
+import hashlib
+import logging
+from threading import Lock
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import faiss
+import numpy as np
+
+LOG = logging.getLogger("ResponseCache")
+
+
+def fingerprint(context: str) -> str:
+    return hashlib.sha1((context or "").encode('utf-8')).hexdigest()
+
+
+class _Entry:
+    __slots__ = ("entry_id", "partition", "query", "outputs", "created")
+
+    def __init__(self, entry_id: int, partition: tuple, query: str, outputs: dict):
+        self.entry_id = entry_id
+        self.partition = partition  # (role, 会话范围, 检索资料指纹)
+        self.query = query
+        self.outputs = outputs
+        self.created = time.time()
+
+
+class ResponseCache:
+    '''
+    语义响应缓存
+    - 同一会话范围(群或私聊用户)内, 角色和检索到的资料相同、问题向量相似度(余弦)不低于 threshold 时直接返回之前的回复;
+      回复依赖该会话的历史记录, 不同群/用户之间不共享
+    - 问题文本完全相同的直接命中, 不计算向量
+    - 条目超过 ttl 失效, 数量超过 max_entries 时按 LRU 淘汰
+    - 完全相同的请求正在生成时, 后来的请求等待其结果, 不重复生成
+    '''
+    def __init__(self, encode, dim: int, threshold: float = 0.92, ttl_minutes: float = 30,
+                 max_entries: int = 1000, candidates: int = 8):
+        '''
+        Args:
+            encode: encode(texts) -> np.ndarray, 复用 FaissIndexer 已加载的向量模型
+        '''
+        self.encode = encode
+        self.threshold = threshold
+        self.ttl = ttl_minutes * 60
+        self.max_entries = max_entries
+        self.candidates = candidates
+        self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(dim))
+        self.entries = OrderedDict()  # {entry_id: _Entry}
+        self.exact = {}  # {(role, 会话范围, 指纹, query): entry_id}
+        self.inflight = {}  # {(role, 会话范围, 指纹, query): Future}
+        self.next_id = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def _embed(self, query: str) -> np.ndarray:
+        vector = np.ascontiguousarray(self.encode([query]), dtype='float32').reshape(1, -1)
+        faiss.normalize_L2(vector)
+        return vector
+
+    def _remove(self, entry_id: int) -> None:
+        entry = self.entries.pop(entry_id)
+        self.exact.pop((*entry.partition, entry.query), None)
+        self.index.remove_ids(np.array([entry_id], dtype='int64'))
+
+    def _fresh(self, entry: _Entry, now: float) -> bool:
+        if now - entry.created <= self.ttl:
+            return True
+        self._remove(entry.entry_id)
+        return False
+
+    def _hit(self, entry: _Entry) -> dict:
+        self.entries.move_to_end(entry.entry_id)
+        self.hits += 1
+        return {**entry.outputs, "cached": True}
+
+    def _lookup(self, partition: tuple, query: str):
+        '''
+        Return:
+            (命中时的 outputs 或 None, 计算过的问题向量或 None)
+        '''
+        now = time.time()
+        with self.lock:
+            entry_id = self.exact.get((*partition, query))
+            if entry_id is not None and self._fresh(self.entries[entry_id], now):
+                return self._hit(self.entries[entry_id]), None
+            if not self.entries:
+                return None, None
+        vector = self._embed(query)
+        with self.lock:
+            k = min(self.candidates, len(self.entries))
+            scores, ids = self.index.search(vector, k) if k else ([[]], [[]])
+            for score, entry_id in zip(scores[0], ids[0]):
+                if score < self.threshold:
+                    break
+                entry = self.entries.get(int(entry_id))
+                if entry is not None and entry.partition == partition and self._fresh(entry, now):
+                    return self._hit(entry), vector
+        return None, vector
+
+    def lookup(self, role: str, context: str, query: str, scope: str = ""):
+        '''
+        Args:
+            scope: 会话范围, 群聊为 roomid, 私聊为 sender
+        Return:
+            命中时返回缓存的 outputs(带 "cached": True), 否则返回 None
+        '''
+        return self._lookup((role, scope, fingerprint(context)), query.strip())[0]
+
+    def put(self, role: str, context: str, query: str, outputs: dict, vector: np.ndarray = None, scope: str = "") -> None:
+        partition = (role, scope, fingerprint(context))
+        query = query.strip()
+        if vector is None:
+            vector = self._embed(query)
+        with self.lock:
+            old = self.exact.get((*partition, query))
+            if old is not None:
+                self._remove(old)
+            entry_id = self.next_id
+            self.next_id += 1
+            self.entries[entry_id] = _Entry(entry_id, partition, query, outputs)
+            self.exact[(*partition, query)] = entry_id
+            self.index.add_with_ids(vector, np.array([entry_id], dtype='int64'))
+            while len(self.entries) > self.max_entries:
+                self._remove(next(iter(self.entries)))
+
+    def get_or_generate(self, role: str, context: str, query: str, generate, scope: str = ""):
+        '''
+        先查缓存, 未命中时调用 generate() 生成并写入缓存
+        Return:
+            (outputs, 是否命中缓存)
+        '''
+        key = (role, scope, fingerprint(context), query.strip())
+        with self.lock:
+            future = self.inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self.inflight[key] = Future()
+        if not owner:  # 相同请求正在生成, 等待其结果
+            outputs = future.result()
+            with self.lock:
+                self.hits += 1
+            return {**outputs, "cached": True}, True
+        try:
+            outputs, vector = self._lookup(key[:3], key[3])
+            if outputs is not None:
+                future.set_result(outputs)
+                return outputs, True
+            with self.lock:
+                self.misses += 1
+            outputs = generate()
+            try:
+                self.put(role, context, query, outputs, vector=vector, scope=scope)
+            except Exception as e:
+                LOG.error(f"写入回复缓存出错: {e}")
+            future.set_result(outputs)
+            return outputs, False
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
+
+    def purge(self) -> None:
+        '''
+        定时任务: 清除过期条目
+        '''
+        now = time.time()
+        with self.lock:
+            expired = [entry_id for entry_id, entry in self.entries.items() if now - entry.created > self.ttl]
+            for entry_id in expired:
+                self._remove(entry_id)
+        if expired:
+            LOG.info(f"清除 {len(expired)} 条过期回复缓存, 剩余 {len(self.entries)} 条")
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
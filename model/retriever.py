@@ -0,0 +1,119 @@
+import math
+import logging
+from threading import Lock
+from collections import defaultdict
+
+import jieba
+
+from utils.utils import load_stopwords
+from utils.name_matcher import get_name_matcher
+from utils.preinfo_store import get_preinfo_store
+from utils.metrics import metrics
+
+LOG = logging.getLogger("Retriever")
+
+
+class BM25Index:
+    '''
+    基于 jieba 分词的 BM25 倒排索引, 文档单位与 FaissIndexer 的片段一致
+    '''
+    def __init__(self, docs: dict, stopwords: set, k1: float = 1.5, b: float = 0.75):
+        '''
+        Args:
+            docs: {chunk_id: text}
+        '''
+        self.k1 = k1
+        self.b = b
+        self.stopwords = stopwords
+        self.postings = defaultdict(list)  # {term: [(chunk_id, tf), ...]}
+        self.doc_len = {}
+        for chunk_id, text in docs.items():
+            tf = defaultdict(int)
+            for term in self.tokenize(text):
+                tf[term] += 1
+            self.doc_len[chunk_id] = sum(tf.values())
+            for term, count in tf.items():
+                self.postings[term].append((chunk_id, count))
+        self.avgdl = sum(self.doc_len.values()) / max(len(self.doc_len), 1)
+
+    def tokenize(self, text: str) -> list:
+        return [w for w in jieba.cut_for_search(text.lower()) if w.strip() and w not in self.stopwords]
+
+    def search(self, query: str, top_k: int = 5) -> list:
+        '''
+        Return:
+            [(chunk_id, score), ...], 查询中没有任何词出现在索引中时返回空列表
+        '''
+        n = len(self.doc_len)
+        scores = defaultdict(float)
+        for term in set(self.tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for chunk_id, tf in postings:
+                norm = 1 - self.b + self.b * self.doc_len[chunk_id] / self.avgdl
+                scores[chunk_id] += idf * tf * (self.k1 + 1) / (tf + self.k1 * norm)
+        return sorted(scores.items(), key=lambda item: -item[1])[:top_k]
+
+
+class HybridRetriever:
+    '''
+    混合检索
+    1. 文本中出现 pre_info 文件名(人名): 直接返回该文件的片段, 不计算向量
+    2. 否则若与文档有词面重合: BM25 与向量检索结果按 RRF 融合
+    3. 都没有: 跳过检索
+    '''
+    def __init__(self, indexer, rrf_k: int = 60):
+        self.indexer = indexer
+        self.rrf_k = rrf_k
+        self.stopwords = load_stopwords()
+        self.bm25 = None
+        self._bm25_source = None  # 构建 BM25 时 indexer 的片段表, 变化后重建
+        self.lock = Lock()
+
+    def _get_bm25(self) -> BM25Index:
+        with self.indexer.swap_lock:
+            filenames, spans = self.indexer.filenames, self.indexer.spans
+        if self._bm25_source is filenames:
+            return self.bm25
+        with self.lock:
+            if self._bm25_source is not filenames:
+                store = get_preinfo_store()
+                docs = {
+                    chunk_id: store.get(name)[int(span[0]):int(span[1])]
+                    for (chunk_id, name), span in zip(filenames.items(), spans)
+                }
+                self.bm25 = BM25Index(docs, self.stopwords)
+                self._bm25_source = filenames
+                LOG.info(f"BM25 索引构建完成: {len(docs)} 个片段")
+        return self.bm25
+
+    def retrieve(self, text: str, top_k: int = 5) -> list:
+        '''
+        Return:
+            [(filename, start, end, score), ...]
+        '''
+        with metrics.stage("name_match"):
+            names = get_name_matcher().match(text)
+        if names:
+            return [chunk for name in names for chunk in self.indexer.file_chunks(name)]
+
+        bm25 = self._get_bm25()
+        with metrics.stage("bm25"):
+            lexical = bm25.search(text, top_k=top_k * 4)
+        if not lexical:
+            return []
+        vector = self.indexer.search_ids_batch([text], top_k=top_k * 4)[0]
+
+        # Reciprocal Rank Fusion
+        scores = defaultdict(float)
+        for hits in (lexical, vector):
+            for rank, (chunk_id, _) in enumerate(hits):
+                scores[chunk_id] += 1 / (self.rrf_k + rank + 1)
+        result = []
+        for chunk_id, score in sorted(scores.items(), key=lambda item: -item[1])[:top_k]:
+            chunk = self.indexer.chunk(chunk_id)
+            if chunk is not None:
+                result.append((*chunk, score))
+        return result
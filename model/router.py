@@ -0,0 +1,177 @@
+import time
+import logging
+from threading import Lock
+from collections import OrderedDict
+
+from model.deepseek import DeepSeek, GenerationStream
+
+LOG = logging.getLogger("Router")
+
+
+def merge_config(base: dict, override: dict) -> dict:
+    '''
+    后端配置覆盖公共配置, 嵌套的配置段(api / cpu / context 等)按键合并
+    '''
+    merged = dict(base)
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_config(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+class Backend:
+    '''
+    路由中的一个推理后端及其负载/健康状态
+    '''
+    def __init__(self, name: str, model: DeepSeek, max_failures: int = 3):
+        self.name = name
+        self.model = model
+        self.max_failures = max_failures
+        self.in_flight = 0
+        self.latency = 0.0  # 最近请求耗时的指数滑动平均(s)
+        self.failures = 0  # 连续失败次数
+        self.ejected_until = 0.0  # 被摘除到该时间点
+
+    def healthy(self, now: float) -> bool:
+        # 被摘除的后端冷却结束后仍需通过健康检查(failures 清零)才能重新接收请求
+        return self.failures < self.max_failures and now >= self.ejected_until
+
+    def score(self) -> float:
+        # 在途请求越多、近期越慢，分数越高
+        return (self.in_flight + 1) * (self.latency or 1.0)
+
+
+class ModelRouter:
+    '''
+    多后端路由
+    - 请求发往在途数 x 近期延迟最小的健康后端
+    - 同一会话固定在同一后端，保持其 KV cache 有效
+    - 连续失败的后端被摘除，冷却后经健康检查重新加入
+    对 Robot 暴露与 DeepSeek 相同的接口
+    '''
+    def __init__(self, config: dict):
+        router = config.get('router', None) or {}
+        self.max_failures = router.get('max_failures', 3)
+        self.eject_seconds = router.get('eject_seconds', 30)
+        self.latency_decay = router.get('latency_decay', 0.8)
+        self.max_sticky = router.get('max_sticky', 10000)
+        self.backends = []
+        base = {k: v for k, v in config.items() if k not in ('backends', 'router')}
+        for i, backend_config in enumerate(config['backends']):
+            name = backend_config.get('name', f"backend-{i}")
+            self.backends.append(Backend(name, DeepSeek(merge_config(base, backend_config)), self.max_failures))
+            LOG.info(f"加载后端: {name} ({backend_config.get('mode', 'local')})")
+        self.sticky = OrderedDict()  # {key: Backend}, 超过 max_sticky 时淘汰最久未使用的会话
+        self.lock = Lock()
+
+        first = self.backends[0].model
+        self.role = first.role
+        self.sys_prompt = first.sys_prompt
+        self.default_messages = first.default_messages
+
+    def _select(self, key=None, exclude=()) -> Backend:
+        now = time.time()
+        with self.lock:
+            backend = self.sticky.get(key)
+            if backend is not None:
+                self.sticky.move_to_end(key)
+            if backend is None or not backend.healthy(now) or backend in exclude:
+                candidates = [b for b in self.backends if b.healthy(now) and b not in exclude]
+                if not candidates:
+                    # 全部被摘除时退而求其次，选最早恢复的
+                    candidates = sorted((b for b in self.backends if b not in exclude), key=lambda b: b.ejected_until)[:1]
+                if not candidates:
+                    return None
+                backend = min(candidates, key=Backend.score)
+                if key is not None:
+                    self.sticky[key] = backend
+                    self.sticky.move_to_end(key)
+                    while len(self.sticky) > self.max_sticky:
+                        self.sticky.popitem(last=False)
+            backend.in_flight += 1
+        return backend
+
+    def _release(self, backend: Backend, cost_time: float = None, error: Exception = None) -> None:
+        with self.lock:
+            backend.in_flight -= 1
+            if error is None:
+                backend.failures = 0
+                if cost_time is not None:
+                    backend.latency = cost_time if not backend.latency else \
+                        self.latency_decay * backend.latency + (1 - self.latency_decay) * cost_time
+                return
+            backend.failures += 1
+            if backend.failures >= self.max_failures:
+                backend.ejected_until = time.time() + self.eject_seconds
+                LOG.error(f"后端 {backend.name} 连续失败 {backend.failures} 次，摘除 {self.eject_seconds}s: {error}")
+
+    def generate(self, messages: list, key=None) -> dict:
+        '''
+        生成回复，当前后端失败时换一个后端重试一次
+        '''
+        tried, last_error = [], None
+        while True:
+            backend = self._select(key, exclude=tried)
+            if backend is None:
+                raise RuntimeError("没有可用的推理后端") from last_error
+            try:
+                outputs = backend.model.generate(messages, key=key)
+            except Exception as e:
+                self._release(backend, error=e)
+                tried.append(backend)
+                last_error = e
+                if len(tried) >= 2:
+                    raise
+                continue
+            self._release(backend, cost_time=outputs['cost_time'])
+            return outputs
+
+    def _stream(self, backend: Backend, messages: list, key=None):
+        stream, error = None, None
+        try:
+            stream = backend.model.generate_stream(messages, key=key)
+            yield from stream
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            outputs = stream.outputs if error is None else None
+            self._release(backend, cost_time=outputs['cost_time'] if outputs else None, error=error)
+        return stream.outputs
+
+    def generate_stream(self, messages: list, key=None) -> GenerationStream:
+        backend = self._select(key)
+        if backend is None:
+            raise RuntimeError("没有可用的推理后端")
+        return GenerationStream(self._stream(backend, messages, key=key), thinking=backend.model.prompt_think)
+
+    def clean_history_messages(self, messages: list, history: int = None, key=None, reserve: int = 0) -> list:
+        with self.lock:
+            backend = self.sticky.get(key) or self.backends[0]
+        return backend.model.clean_history_messages(messages, history=history, key=key, reserve=reserve)
+
+    def healthCheck(self) -> None:
+        '''
+        定时任务: 对冷却结束的后端做健康检查，通过则重新加入，否则继续摘除
+        '''
+        now = time.time()
+        for backend in self.backends:
+            if backend.failures < self.max_failures or now < backend.ejected_until:
+                continue
+            if backend.model.ping():
+                with self.lock:
+                    backend.failures = 0
+                LOG.info(f"后端 {backend.name} 恢复")
+            else:
+                backend.ejected_until = now + self.eject_seconds
+
+
+def build_model(config: dict):
+    '''
+    模型配置中声明了 backends 时使用多后端路由，否则使用单个 DeepSeek
+    '''
+    if config.get('backends'):
+        return ModelRouter(config)
+    return DeepSeek(config)
@@ -0,0 +1,83 @@
+import os
+import numpy as np
+
+
+class StringTable:
+    '''
+    紧凑的 id -> 字符串 映射表, 替代 pickle 保存的 filenames.npy
+    磁盘格式(直接读取数组, 无需反序列化):
+        {name}.ids.npy      int64, 升序
+        {name}.offsets.npy  int64, 长度为 len(ids) + 1
+        {name}.bin          utf-8 拼接的字符串
+    '''
+    def __init__(self, ids, offsets, data):
+        self.ids = ids
+        self.offsets = offsets
+        self.data = data
+
+    @classmethod
+    def from_dict(cls, mapping: dict) -> "StringTable":
+        ids = np.array(sorted(mapping), dtype='int64')
+        encoded = [mapping[int(i)].encode('utf-8') for i in ids]
+        offsets = np.zeros(len(ids) + 1, dtype='int64')
+        offsets[1:] = np.cumsum([len(b) for b in encoded])
+        data = np.frombuffer(b"".join(encoded), dtype='uint8')
+        return cls(ids, offsets, data)
+
+    @classmethod
+    def from_list(cls, strings) -> "StringTable":
+        return cls.from_dict({i: s for i, s in enumerate(strings)})
+
+    @staticmethod
+    def exists(save_dir: str, name: str = "filenames") -> bool:
+        return os.path.exists(os.path.join(save_dir, f"{name}.bin"))
+
+    @classmethod
+    def load(cls, save_dir: str, name: str = "filenames", mmap: bool = False) -> "StringTable":
+        '''
+        mmap=True 时映射文件而不读入内存; Windows 上被映射的文件不能被 os.replace 覆盖,
+        之后还要 save 到同一目录时不要使用
+        '''
+        mmap_mode = 'r' if mmap else None
+        ids = np.load(os.path.join(save_dir, f"{name}.ids.npy"), mmap_mode=mmap_mode)
+        offsets = np.load(os.path.join(save_dir, f"{name}.offsets.npy"), mmap_mode=mmap_mode)
+        path = os.path.join(save_dir, f"{name}.bin")
+        if mmap and os.path.getsize(path) > 0:
+            data = np.memmap(path, dtype='uint8', mode='r')
+        else:
+            data = np.fromfile(path, dtype='uint8')
+        return cls(ids, offsets, data)
+
+    def save(self, save_dir: str, name: str = "filenames") -> None:
+        '''
+        先写临时文件再替换, 读取方不会看到写了一半的文件
+        '''
+        def replace(filename, write):
+            path = os.path.join(save_dir, filename)
+            with open(path + ".tmp", 'wb') as fout:
+                write(fout)
+            os.replace(path + ".tmp", path)
+
+        replace(f"{name}.ids.npy", lambda f: np.save(f, np.asarray(self.ids)))
+        replace(f"{name}.offsets.npy", lambda f: np.save(f, np.asarray(self.offsets)))
+        replace(f"{name}.bin", lambda f: f.write(np.asarray(self.data).tobytes()))
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def position(self, key) -> int:
+        '''
+        key 在表中的行号, 可用于查找与该表对齐的其他数组
+        '''
+        pos = int(np.searchsorted(self.ids, key))
+        if pos >= len(self.ids) or self.ids[pos] != key:
+            raise KeyError(key)
+        return pos
+
+    def __getitem__(self, key) -> str:
+        pos = self.position(key)
+        return bytes(self.data[self.offsets[pos]:self.offsets[pos + 1]]).decode('utf-8')
+
+    def items(self):
+        for pos, key in enumerate(self.ids):
+            yield int(key), bytes(self.data[self.offsets[pos]:self.offsets[pos + 1]]).decode('utf-8')
@@ -0,0 +1,82 @@
+from transformers import LogitsProcessor
+
+
+class ThinkBudget:
+    '''
+    单个序列的思考长度控制: <think> 之后生成的 token 数达到 budget 时, 强制依次生成 </think>
+    - force() 返回下一步必须生成的 token, None 表示不限制
+    - update(token) 记录实际生成的 token
+    '''
+    def __init__(self, budget: int, open_ids: list, close_ids: list, thinking: bool = False):
+        '''
+        Args:
+            thinking: prompt 是否已以 <think> 结尾(R1 的对话模板会在生成提示后加上 <think>)
+        '''
+        self.budget = budget
+        self.open_ids = open_ids
+        self.close_ids = close_ids
+        self.state = "thinking" if thinking else "before"  # before | thinking | done
+        self.count = 0  # 思考部分已生成的 token 数
+        self.forced = 0  # 已强制生成的 </think> token 数
+        self.window = max(len(open_ids), len(close_ids))
+        self.tail = []
+
+    def _ends_with(self, ids: list) -> bool:
+        return self.tail[-len(ids):] == ids
+
+    def force(self):
+        if self.state != "thinking":
+            return None
+        if self.forced or self.count >= self.budget:
+            return self.close_ids[self.forced]
+        return None
+
+    def update(self, token: int) -> None:
+        expected = self.force()
+        self.tail.append(token)
+        del self.tail[:-self.window]
+        if self.state == "before":
+            if self._ends_with(self.open_ids):
+                self.state = "thinking"
+        elif self.state == "thinking":
+            self.count += 1
+            if expected is not None and token == expected:
+                self.forced += 1
+            if self._ends_with(self.close_ids):
+                self.state = "done"
+
+
+class ThinkTokens:
+    '''
+    <think> / </think> 的 token id 与思考预算, 为每个请求创建 ThinkBudget
+    '''
+    def __init__(self, tokenizer, budget: int):
+        self.budget = budget
+        self.open_ids = tokenizer.encode("<think>", add_special_tokens=False)
+        self.close_ids = tokenizer.encode("</think>", add_special_tokens=False)
+
+    def start(self, prompt_ids: list) -> ThinkBudget:
+        # 对话模板在 <think> 之后可能还有换行
+        tail = list(prompt_ids[-len(self.open_ids) - 2:])
+        thinking = any(tail[i:i + len(self.open_ids)] == self.open_ids for i in range(len(tail)))
+        return ThinkBudget(self.budget, self.open_ids, self.close_ids, thinking)
+
+
+class ThinkBudgetProcessor(LogitsProcessor):
+    '''
+    model.generate 使用的 logits processor: 超出思考预算的序列只保留 </think> 的 logits
+    '''
+    def __init__(self, budgets: list, prompt_len: int):
+        self.budgets = budgets
+        self.prompt_len = prompt_len
+
+    def __call__(self, input_ids, scores):
+        if input_ids.shape[1] > self.prompt_len:  # 第一次调用时还没有生成 token
+            for budget, token in zip(self.budgets, input_ids[:, -1].tolist()):
+                budget.update(token)
+        for row, budget in enumerate(self.budgets):
+            token = budget.force()
+            if token is not None:
+                scores[row, :] = -float("inf")
+                scores[row, token] = 0
+        return scores
@@ -4,41 +4,147 @@ import re
 import time
 import xml.etree.ElementTree as ET
 from queue import Empty
-from threading import Thread
+from threading import Thread, Event
+from concurrent.futures import ThreadPoolExecutor, wait
 
 from utils.utils import load_user_config
 from wcferry import Wcf, WxMsg
-from model.deepseek import DeepSeek
 from configs.robot_config import Config
 from job_mgmt import Job
 # from utils.func_news import News
-from utils.utils import load_model_config, load_preinfo, remove_stopwords, extract_name
-from model.FaissIndexer import FaissIndexer
+from utils.utils import load_model_config, load_passages, remove_stopwords, estimate_tokens
+from utils.dispatcher import MessageDispatcher
+from utils.stream import StreamSegmenter
+from utils.conversation_store import ConversationStore
+from utils.startup import StartupProfiler
+from utils.contacts import ContactCache
+from utils.sender import OutboundSender
+from utils.metrics import metrics
+# torch / transformers / faiss / sentence_transformers 等较重的依赖在后台初始化线程中导入
 
 __version__ = "39.2.4.0"
 
 class Robot(Job):
-    def __init__(self, config: Config, wcf: Wcf, model_name: str = None) -> None:
+    def __init__(self, config: Config, wcf: Wcf, model_name: str = None, profiler: StartupProfiler = None) -> None:
         self.wcf = wcf
         self.config = config
         self.LOG = logging.getLogger("Robot")
+        self.profiler = profiler or StartupProfiler()
         self.wxid = self.wcf.get_self_wxid()
         self.wx_info = wcf.get_user_info()  # {'wxid': xxx, 'name': xxx, 'home': root_path}
-        self.allContacts = self.getAllContacts()
+        # 联系人 & 群昵称缓存, 先用上次的快照, 启动后在后台刷新
+        self.contacts = ContactCache(self.wcf, **self.config.CONTACTS.get("cache", {}))
+        self.contacts.restore()
+        self.onEveryMinutes(self.config.CONTACTS.get("refresh_minutes", 30), self.contacts.refresh)
+        # 发送队列: 在独立线程中限速发送, 生成回复的线程不会被发送阻塞
+        sender_config = dict(self.config.SENDER)
+        stats_minutes = sender_config.pop("stats_minutes", 5)
+        self.sender = OutboundSender(self.deliverTextMsg, **sender_config)
+        self.sender.start()
+        self.onEveryMinutes(stats_minutes, self.logSenderStats)
+        # 各阶段耗时 & 计数: 本机 HTTP 接口 + 定时写出 json
+        if self.config.METRICS.get("enable", False):
+            try:
+                metrics.serve(self.config.METRICS.get("host", "127.0.0.1"), self.config.METRICS.get("port", 9108))
+            except OSError as e:
+                self.LOG.error(f"metrics 服务启动失败：{e}")
+            if self.config.METRICS.get("dump_path"):
+                self.onEveryMinutes(self.config.METRICS.get("dump_minutes", 5), self.dumpMetrics)
         self.model_name = model_name
         self.user_default_config = load_user_config()
-        self.user = {}  # {'user_name': {'config': {...}, 'history': [...]}}
+        # {sender: Conversation}, 内存中保留活跃会话, 其余存入 SQLite
+        with self.profiler.phase("conversation_store"):
+            self.user = ConversationStore(self.user_default_config, **self.config.CONVERSATION)
+        self.onEveryMinutes(1, self.user.evictIdle)
         self.rag = True
         self.instructions = {}
 
-        self.index = FaissIndexer()
-        self.index.load_index()
-
-        if model_name is not None:
-            model_config = load_model_config(model_name)
-            self.model : DeepSeek = DeepSeek(model_config)
+        # 联系人、检索索引、大模型在后台并行初始化, 初始化完成前即可接收消息
+        self.index = None
+        self.retriever = None
+        self.responseCache = None
+        self.model = None
+        self.retrievalReady = Event()
+        self.modelReady = Event()
+        self.initialized = Event()
+        self.initialize()
+
+    def initialize(self) -> None:
+        executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="Startup")
+        futures = [
+            executor.submit(self.profiler.run, "contacts", self.loadContacts),
+            executor.submit(self.profiler.run, "retrieval", self.initRetrieval, executor),
+            executor.submit(self.profiler.run, "llm", self.initModel),
+        ]
+
+        def finish():
+            wait(futures)
+            executor.shutdown()
+            self.modelReady.set()  # 加载失败时也不再等待
+            self.retrievalReady.set()
+            self.initialized.set()
+            self.LOG.info(f"初始化完成, 耗时 {time.perf_counter() - self.profiler.start:.2f}s")
+
+        Thread(target=finish, name="StartupWatcher", daemon=True).start()
+
+    def loadContacts(self) -> None:
+        self.contacts.refresh()
+
+    def initRetrieval(self, executor: ThreadPoolExecutor) -> None:
+        """
+        向量模型与已保存的索引并行加载, 都完成后增量同步并创建检索器
+        """
+        with self.profiler.phase("import faiss"):
+            from model.FaissIndexer import FaissIndexer
+            from model.retriever import HybridRetriever
+        index = FaissIndexer(**self.config.RETRIEVAL.get("index", {}), load_model=False)
+        embedding = executor.submit(self.profiler.run, "embedding_model", index.load_model)
+        with self.profiler.phase("load_index"):
+            index.load_index()
+        embedding.result()
+        if index.model is None:
+            raise RuntimeError("向量模型加载失败")
+        self.index = index
+        self.profiler.run("sync_index", self.syncIndex)
+        self.onEveryMinutes(1, self.syncIndex)  # pre_info 有增删改时增量更新索引
+        self.retriever = HybridRetriever(self.index)
+        self.retrievalReady.set()
+        # 回复缓存复用检索的向量模型
+        cache_config = dict(self.user_default_config.get('response_cache', None) or {})
+        if cache_config.pop('enable', False):
+            from model.response_cache import ResponseCache
+            for key in ('private', 'exclude_groups'):
+                cache_config.pop(key, None)
+            self.responseCache = ResponseCache(
+                self.index.encode_queries, self.index.model.get_sentence_embedding_dimension(), **cache_config)
+            self.onEveryMinutes(5, self.responseCache.purge)
+
+    def initModel(self) -> None:
+        if self.model_name is None:
+            return
+        with self.profiler.phase("import model"):
+            from model.router import ModelRouter, build_model
+        model_config = load_model_config(self.model_name)
+        model = build_model(model_config)  # 配置了 backends 时为 ModelRouter
+        if isinstance(model, ModelRouter):
+            self.onEverySeconds(model_config.get('router', {}).get('health_check_seconds', 10), model.healthCheck)
+        self.model = model
+        self.modelReady.set()
+        self.LOG.info(f"初始化模型: {self.model_name}")
+
+    def waitModel(self) -> bool:
+        """
+        模型仍在加载时, 消息在工作线程中最多等待 startup.wait_model_seconds 秒
+        """
+        return self.modelReady.wait(self.config.STARTUP.get("wait_model_seconds", 60)) and self.model is not None
 
-        self.LOG.info(f"初始化模型: {model_name}")
+    def syncIndex(self) -> None:
+        if self.index is None:
+            return
+        try:
+            self.index.sync()
+        except Exception as e:
+            self.LOG.error(f"同步索引出错：{e}")
 
     @staticmethod
     def value_check(args: dict) -> bool:
@@ -54,39 +160,59 @@ class Robot(Job):
         """
         return self.toChitchat(msg, pre_info)
     
-    def mask_think(self, response: str) -> str:
-        begin = response.find("<think>")
+    def mask_think(self, response: str, thinking: bool = False) -> str:
+        """
+        去掉思考部分, 思考未结束(被截断)时返回空字符串
+        :param thinking: prompt 是否已打开 <think>(R1 模板的生成提示以 <think> 结尾), 否则只有以 <think> 开头的回复含思考部分
+        """
+        if not thinking and not response.lstrip().startswith("<think>"):
+            return response
         end = response.find("</think>")
-        return response[end+10:]
+        if end < 0:
+            return ""
+        return response[end + len("</think>"):].lstrip("\n")
 
     def toChitchat(self, msg: WxMsg, pre_info: str=None) -> bool:
         """
         闲聊模式
         """
-        if self.model_name:
-            # wait_msg = f"思考ing...\n请等待, 前面还有 {self.wcf.msgQ.qsize()} 人"
-            # self.replyTextMsg(wait_msg, msg)
+        if self.model_name and not self.waitModel():
+            rsp = "模型加载中喵~请稍后再试~"
+        elif self.model_name:
             # 初始化用户配置 & 处理用户历史记录
-            if msg.sender not in self.user:
-                self.user[msg.sender] = {}
-                self.user[msg.sender]['config'] = self.user_default_config
-                self.user[msg.sender]['history'] = self.model.default_messages + [{"role": "user", "content": msg.content}]
+            # 会话持有消息副本, 配置只记录相对默认配置的修改项, 不会改到共享的默认值
+            context = pre_info if self.rag else None
+            conv = self.user.get(msg.sender)
+            if conv is None:
+                conv = self.user.create(msg.sender, self.model.default_messages + [{"role": "user", "content": msg.content}])
             else:
-                self.user[msg.sender]['history'].append({"role": "user", "content": msg.content})
-                self.user[msg.sender]['history'] = self.model.clean_history_messages(self.user[msg.sender]['history'], history=5)
-            # 使用RAG, 添加前置知识
-            if self.rag and pre_info is not None:
-                self.user[msg.sender]['history'][0]['content'] = pre_info + self.user[msg.sender]['history'][0]['content']
-            # 生成回复
-            outputs = self.model.generate(self.user[msg.sender]['history'])
-            self.user[msg.sender]['history'].append({"role": "assistant", "content": outputs['response']})
-            if self.user[msg.sender]['config']['mask_think']:
-                outputs['response'] = self.mask_think(outputs['response'])
-            rsp = \
-            f"{outputs['response']}\n" + \
-            f"| Cost time: {outputs['cost_time']:.2f}s |\n" + \
-            f"| Token nums: {outputs['token_num']} |\n" + \
-            f"| Token speed: {outputs['token_speed']:.2f} token/s |"
+                conv.append("user", msg.content)
+                conv.history = self.model.clean_history_messages(
+                    conv.history, key=msg.sender, reserve=estimate_tokens(context) if context else 0)
+            # 使用RAG, 前置知识只注入本轮 prompt, 不写入历史记录
+            prompt = self.buildPrompt(conv, context)
+            # 流式回复: 每生成完一句/一段就发送
+            stream = conv.config.get('stream', False)
+            if stream:
+                generate = lambda: self.streamChitchat(msg, conv, prompt)
+            else:
+                generate = lambda: self.model.generate(prompt, key=msg.sender)
+            # 生成回复, 相似问题命中缓存时直接使用之前的回复
+            cache = self.responseCacheFor(msg)
+            if cache is not None:
+                # 回复依赖会话历史, 只在同一个群(私聊为同一用户)内复用
+                scope = msg.roomid if msg.from_group() else msg.sender
+                outputs, hit = cache.get_or_generate(self.model.role, context, msg.content, generate, scope=scope)
+            else:
+                outputs, hit = generate(), False
+            self.observeGeneration(outputs, hit)
+            # 历史记录只保存最终回答, 之后每轮不再重复 prefill 思考部分
+            conv.append("assistant", self.mask_think(outputs['response'], outputs.get('thinking', False)))
+            self.user.touch(conv)
+            if stream and not hit:  # 已边生成边发送
+                return True
+            response = self.mask_think(outputs['response'], outputs.get('thinking', False)) if conv.config['mask_think'] else outputs['response']
+            rsp = f"{response}\n{self.statsFooter(outputs)}" if conv.config.get('stats_footer', True) else response
         else:  # 自动回复
             rsp = "模型未启动喵~这里是自动回复喵~"
 
@@ -99,6 +225,75 @@ class Robot(Job):
             self.LOG.error(f"目前人数较多，服务器繁忙，请稍后再试")
             return False
 
+    def buildPrompt(self, conv, context: str=None) -> list:
+        """
+        构造本轮 prompt: 检索到的资料拼接在最新一条用户消息前
+        系统提示词和之前的历史记录保持不变, 可以复用上一轮的 KV cache
+        """
+        prompt = conv.prompt()
+        if context:
+            prompt[-1]['content'] = context + prompt[-1]['content']
+        return prompt
+
+    def responseCacheFor(self, msg: WxMsg):
+        """
+        该消息可使用的回复缓存: 未开启、私聊(未开启 private)、群在 exclude_groups 中时返回 None
+        """
+        if self.responseCache is None:
+            return None
+        config = self.user_default_config.get('response_cache', None) or {}
+        if msg.from_group():
+            return None if msg.roomid in (config.get('exclude_groups', None) or []) else self.responseCache
+        return self.responseCache if config.get('private', False) else None
+
+    @staticmethod
+    def observeGeneration(outputs: dict, hit: bool) -> None:
+        """
+        记录生成耗时: 首 token 之前为 prefill(含排队), 之后为 decode
+        """
+        metrics.inc("responses_total", source="cache" if hit else "model")
+        if hit:
+            return
+        metrics.observe("stage_seconds", outputs['cost_time'], stage="generate")
+        metrics.inc("generated_tokens_total", outputs['token_num'])
+        if outputs.get('ttft') is not None:
+            metrics.observe("stage_seconds", outputs['ttft'], stage="prefill")
+            metrics.observe("stage_seconds", outputs['cost_time'] - outputs['ttft'], stage="decode")
+
+    def dumpMetrics(self) -> None:
+        try:
+            metrics.dump(self.config.METRICS["dump_path"])
+        except Exception as e:
+            self.LOG.error(f"写出 metrics 出错：{e}")
+
+    @staticmethod
+    def statsFooter(outputs: dict) -> str:
+        return \
+            f"| Cost time: {outputs['cost_time']:.2f}s |\n" + \
+            f"| Token nums: {outputs['token_num']} |\n" + \
+            f"| Token speed: {outputs['token_speed']:.2f} token/s |" + \
+            ("\n| From cache |" if outputs.get('cached') else "")
+
+    def streamChitchat(self, msg: WxMsg, conv, prompt: list) -> dict:
+        """
+        流式闲聊: 边生成边按句子/段落发送, mask_think 时实时屏蔽思考部分
+        Return:
+            与 generate 相同格式的统计信息
+        """
+        config = conv.config
+        stream = self.model.generate_stream(prompt, key=msg.sender)
+        segmenter = StreamSegmenter(mask_think=config['mask_think'], min_chars=config.get('stream_min_chars', 30),
+                                    thinking=stream.thinking)
+        for chunk in stream:
+            for segment in segmenter.feed(chunk):
+                self.replyTextMsg(segment, msg)
+        outputs = stream.outputs
+        rest = "\n".join(segmenter.flush())
+        footer = self.statsFooter(outputs) if config.get('stats_footer', True) else ""
+        if rest or footer:
+            self.replyTextMsg(f"{rest}\n{footer}" if rest and footer else rest or footer, msg)
+        return outputs
+
     def processMsg(self, msg: WxMsg) -> None:
         """
         当接收到消息的时候，会调用本方法。如果不实现本方法，则打印原始消息。
@@ -110,8 +305,11 @@ class Robot(Job):
         """
 
         if msg.content == '/clean':
-            self.user[msg.sender]['history'] = self.model.clean_history_messages(self.user[msg.sender]['history'], history=0)
-            self.sendTextMsg(f"{msg.sender}的历史记录清理完毕, 当前列表长度: {len(self.user[msg.sender]['history'])-1}", msg.sender)
+            conv = self.user.get(msg.sender)
+            if conv is not None and self.waitModel():
+                conv.history = self.model.clean_history_messages(conv.history, history=0, key=msg.sender)
+                self.user.touch(conv)
+            self.sendTextMsg(f"{msg.sender}的历史记录清理完毕, 当前列表长度: {len(conv.history)-1 if conv else 0}", msg.sender)
             return
 
         # 群聊消息
@@ -123,15 +321,20 @@ class Robot(Job):
             if msg.is_at(self.wxid):  # 被@
                 # msg.content = str(msg.content[len(self.wx_info['name'])+2:])
                 # print(msg.content)
-                if self.rag:
+                pre_info = None
+                if self.rag and self.retrievalReady.is_set() and self.retriever is not None:  # 检索未就绪时不使用 RAG
                     # print(msg.content)
                     # content = remove_stopwords(msg.content)  # 去除停用词
-                    content = extract_name(msg.content)
-                    # print(f"extract_name content: {content}")
-                    content = ",".join(content)
-                    file_names = self.index.search_filename(content, topk=2)  # 搜索文件名
-                    # print(f"file_names: {file_names}")
-                    pre_info = load_preinfo(file_names)
+                    # 人名精确命中直接取对应文件, 否则 BM25 + 向量混合检索, 都没有命中则跳过
+                    with metrics.stage("retrieval"):
+                        chunks = self.retriever.retrieve(msg.content, top_k=self.config.RETRIEVAL.get("top_k", 5))
+                    # print(f"chunks: {chunks}")
+                    if chunks:
+                        # 对话中已出现过原文的片段不再重复注入
+                        conv = self.user.get(msg.sender)
+                        seen = "\n".join(m.content for m in conv.history[1:]) if conv else ""
+                        with metrics.stage("preinfo_load"):
+                            pre_info = load_passages(chunks, max_tokens=self.config.RETRIEVAL.get("max_context_tokens", 1024), seen=seen) or None
                     # print(f"pre_info: {pre_info}")
                     # print("=====================================================")
                 self.toAt(msg, pre_info)
@@ -165,13 +368,59 @@ class Robot(Job):
     def enableRecvMsg(self) -> None:
         self.wcf.enable_recv_msg(self.onMsg)
 
+    def dispatchKey(self, msg: WxMsg):
+        """
+        消息的会话标识，同一标识的消息按顺序处理
+        好友请求、系统消息、指令以及无需回复的群消息返回 None，进入快速通道
+        """
+        if msg.type in (37, 10000) or msg.from_self() or msg.content.startswith('/'):
+            return None
+        if msg.from_group() and (msg.roomid not in self.config.GROUPS or not msg.is_at(self.wxid)):
+            return None
+        return msg.sender  # 历史记录按 sender 保存，同一 sender 的消息需保持顺序
+
+    @staticmethod
+    def coalesceMsgs(msgs: list) -> WxMsg:
+        """
+        同一用户连续发送的多条消息合并为一轮对话
+        """
+        msg = msgs[-1]
+        msg.content = "\n".join(m.content for m in msgs)
+        return msg
+
+    def admissionNotice(self, msg: WxMsg, event: str, position: int = None) -> None:
+        """
+        准入控制的即时回复: 排队位置 / 繁忙 / 排队过久被丢弃
+        """
+        if event == "queued":
+            self.replyTextMsg(f"思考ing...\n请等待, 前面还有 {position} 人", msg)
+        elif event == "busy":
+            self.replyTextMsg("目前人数较多，服务器繁忙，请稍后再试喵~", msg)
+        elif event == "stale":
+            self.replyTextMsg("消息等待太久已被忽略，请重新发送喵~", msg)
+
     def enableReceivingMsg(self) -> None:
+        dispatcher_config = self.config.DISPATCHER
+        self.dispatcher = MessageDispatcher(
+            self.processMsg,
+            workers=dispatcher_config.get("workers", 4),
+            fast_workers=dispatcher_config.get("fast_workers", 2),
+            max_queue=dispatcher_config.get("max_queue", 200),
+            max_pending_per_key=dispatcher_config.get("max_pending_per_user", 5),
+            coalesce_seconds=dispatcher_config.get("coalesce_seconds", 0),
+            merge=self.coalesceMsgs,
+            max_inflight_per_group=dispatcher_config.get("max_inflight_per_room", 0),
+            notice_threshold=dispatcher_config.get("notice_threshold", 0),
+            stale_seconds=dispatcher_config.get("stale_seconds", 0),
+            notify=self.admissionNotice,
+        )
+
         def innerProcessMsg(wcf: Wcf):
             while wcf.is_receiving_msg():
                 try:
                     msg = wcf.get_msg()
                     self.LOG.info(msg)
-                    self.processMsg(msg)
+                    self.dispatcher.submit(self.dispatchKey(msg), msg, group=msg.roomid if msg.from_group() else None)
                 except Empty:
                     continue  # Empty message
                 except Exception as e:
@@ -181,11 +430,17 @@ class Robot(Job):
         Thread(target=innerProcessMsg, name="GetMessage", args=(self.wcf,), daemon=True).start()
 
     def sendTextMsg(self, msg: str, receiver: str, at_list: str = "") -> None:
-        """ 发送消息
+        """ 发送消息(加入发送队列, 超长消息按段落拆分, 由发送线程限速发送)
         :param msg: 消息字符串
         :param receiver: 接收人wxid或者群id
         :param at_list: 要@的wxid, @所有人的wxid为: notify@all
         """
+        self.sender.send(msg, receiver, at_list)
+
+    def deliverTextMsg(self, msg: str, receiver: str, at_list: str = "") -> None:
+        """
+        发送线程中实际调用 wcf 发送消息
+        """
         # msg 中需要有 @ 名单中一样数量的 @
         ats = ""
         if at_list:
@@ -195,7 +450,7 @@ class Robot(Job):
                 wxids = at_list.split(",")
                 for wxid in wxids:
                     # 根据 wxid 查找群昵称
-                    ats += f" @{self.wcf.get_alias_in_chatroom(wxid, receiver)}"
+                    ats += f" @{self.contacts.alias(wxid, receiver)}"
 
         # {msg}{ats} 表示要发送的消息内容后面紧跟@，例如 北京天气情况为：xxx @张三
         if ats == "":
@@ -205,6 +460,14 @@ class Robot(Job):
             self.LOG.info(f"To {receiver}: {ats}\r{msg}")
             self.wcf.send_text(f"{ats}\n\n{msg}", receiver, at_list)
 
+    def logSenderStats(self) -> None:
+        stats = self.sender.stats()
+        self.LOG.info(
+            f"发送队列: 排队 {stats['pending']} | 已发送 {stats['sent']} | 合并 {stats['merged']} | "
+            f"丢弃 {stats['dropped']} | 失败 {stats['failed']} | 排队延迟 p50 {stats['latency_p50']:.2f}s "
+            f"p95 {stats['latency_p95']:.2f}s max {stats['latency_max']:.2f}s"
+        )
+
     def replyTextMsg(self, rsp: str, msg: WxMsg) -> None:
         '''
         回复消息
@@ -219,8 +482,7 @@ class Robot(Job):
         获取联系人（包括好友、公众号、服务号、群成员……）
         格式: {"wxid": "NickName"}
         """
-        contacts = self.wcf.query_sql("MicroMsg.db", "SELECT UserName, NickName FROM Contact;")
-        return {contact["UserName"]: contact["NickName"] for contact in contacts}
+        return dict(self.contacts.contacts)
 
     def keepRunningAndBlockProcess(self) -> None:
         """
@@ -245,7 +507,7 @@ class Robot(Job):
         nickName = re.findall(r"你已添加了(.*)，现在可以开始聊天了。", msg.content)
         if nickName:
             # 添加了好友，更新好友列表
-            self.allContacts[msg.sender] = nickName[0]
+            self.contacts.add_contact(msg.sender, nickName[0])
             self.sendTextMsg(f"Hi {nickName[0]}，我自动通过了你的好友请求。", msg.sender)
 
     # def newsReport(self) -> None:
@@ -0,0 +1,127 @@
+import os
+import json
+import time
+import logging
+from threading import Lock
+
+LOG = logging.getLogger("ContactCache")
+
+
+def parse_room_data(data: bytes) -> dict:
+    '''
+    解析 ChatRoom 表的 RoomData 字段
+    Return:
+        {wxid: 群昵称}, 未设置群昵称的成员为空字符串
+    '''
+    from wcferry.roomdata_pb2 import RoomData
+    room_data = RoomData()
+    room_data.ParseFromString(data)
+    return {member.wxid: member.name for member in room_data.members}
+
+
+class ContactCache:
+    '''
+    联系人 & 群成员昵称缓存, 替代每次 @ 时调用 wcf.get_alias_in_chatroom(每次两条 SQL)
+    - 联系人表整体加载一次, 之后定时刷新
+    - 群成员按群加载, 一个群一条 SQL; 查不到的成员(如新入群)按需重新加载该群, 并限制频率
+    - 快照保存在本地, 重启后先使用快照, 再在后台刷新
+    '''
+    def __init__(self, wcf, snapshot_path: str = "data/contacts.json", room_ttl_minutes: float = 30,
+                 miss_reload_seconds: float = 60, room_parser=parse_room_data):
+        self.wcf = wcf
+        self.snapshot_path = snapshot_path
+        self.room_ttl = room_ttl_minutes * 60
+        self.miss_reload_seconds = miss_reload_seconds
+        self.room_parser = room_parser
+        self.contacts = {}  # {wxid: NickName}
+        self.rooms = {}  # {roomid: (loaded_at, {wxid: 群昵称})}
+        self.lock = Lock()
+
+    def restore(self) -> bool:
+        '''
+        从快照恢复, 快照中的群成员视为已过期, 下次刷新时重新加载
+        '''
+        try:
+            with open(self.snapshot_path, 'r', encoding='utf-8') as fin:
+                snapshot = json.load(fin)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as e:
+            LOG.error(f"读取联系人快照出错: {e}")
+            return False
+        with self.lock:
+            self.contacts = {**snapshot.get("contacts", {}), **self.contacts}
+            for roomid, members in snapshot.get("rooms", {}).items():
+                self.rooms.setdefault(roomid, (0.0, members))
+        LOG.info(f"从快照恢复 {len(self.contacts)} 个联系人, {len(self.rooms)} 个群")
+        return True
+
+    def save(self) -> None:
+        with self.lock:
+            snapshot = {
+                "contacts": dict(self.contacts),
+                "rooms": {roomid: members for roomid, (_, members) in self.rooms.items()},
+            }
+        if os.path.dirname(self.snapshot_path):
+            os.makedirs(os.path.dirname(self.snapshot_path), exist_ok=True)
+        # 先写临时文件再替换, 中途退出不会损坏快照
+        with open(self.snapshot_path + ".tmp", 'w', encoding='utf-8') as fout:
+            json.dump(snapshot, fout, ensure_ascii=False)
+        os.replace(self.snapshot_path + ".tmp", self.snapshot_path)
+
+    def load_contacts(self) -> dict:
+        contacts = self.wcf.query_sql("MicroMsg.db", "SELECT UserName, NickName FROM Contact;")
+        contacts = {contact["UserName"]: contact["NickName"] for contact in contacts}
+        with self.lock:
+            self.contacts = contacts
+        return contacts
+
+    def load_room(self, roomid: str) -> dict:
+        '''
+        一条 SQL 加载整个群的成员昵称
+        '''
+        escaped = roomid.replace("'", "''")
+        rows = self.wcf.query_sql("MicroMsg.db", f"SELECT RoomData FROM ChatRoom WHERE ChatRoomName = '{escaped}';")
+        members = {}
+        if rows and rows[0].get("RoomData"):
+            try:
+                members = self.room_parser(rows[0]["RoomData"])
+            except Exception as e:
+                LOG.error(f"解析群 {roomid} 成员出错: {e}")
+        with self.lock:
+            self.rooms[roomid] = (time.time(), members)
+        return members
+
+    def add_contact(self, wxid: str, name: str) -> None:
+        with self.lock:
+            self.contacts[wxid] = name
+
+    def nickname(self, wxid: str) -> str:
+        return self.contacts.get(wxid, "")
+
+    def alias(self, wxid: str, roomid: str) -> str:
+        '''
+        群昵称, 未设置时返回微信昵称, 与 wcf.get_alias_in_chatroom 一致
+        '''
+        entry = self.rooms.get(roomid)
+        if entry is None or (wxid not in entry[1] and time.time() - entry[0] > self.miss_reload_seconds):
+            members = self.load_room(roomid)
+        else:
+            members = entry[1]
+        if wxid not in members:
+            return ""
+        return members[wxid] or self.contacts.get(wxid, "")
+
+    def refresh(self) -> None:
+        '''
+        定时任务: 重新加载联系人和过期的群, 并保存快照
+        '''
+        try:
+            self.load_contacts()
+            now = time.time()
+            for roomid, (loaded_at, _) in list(self.rooms.items()):
+                if now - loaded_at > self.room_ttl:
+                    self.load_room(roomid)
+            self.save()
+        except Exception as e:
+            LOG.error(f"刷新联系人出错: {e}")
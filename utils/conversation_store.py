@@ -0,0 +1,208 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import logging
+from threading import Lock
+from collections import OrderedDict, ChainMap
+
+LOG = logging.getLogger("ConversationStore")
+
+
+class Message:
+    '''
+    单条消息, 兼容 dict 的 message["role"] / message.get("content") 访问方式
+    "_tokens" 对应 tokens 字段(DeepSeek.count_tokens 缓存的 token 数)
+    '''
+    __slots__ = ("role", "content", "tokens")
+    _FIELDS = {"role": "role", "content": "content", "_tokens": "tokens"}
+
+    def __init__(self, role: str, content: str, tokens=None):
+        self.role = role
+        self.content = content
+        self.tokens = tokens
+
+    @classmethod
+    def from_dict(cls, message) -> "Message":
+        if isinstance(message, Message):
+            return message
+        return cls(message["role"], message["content"], message.get("_tokens"))
+
+    def __getitem__(self, key):
+        return getattr(self, self._FIELDS[key])
+
+    def __setitem__(self, key, value):
+        setattr(self, self._FIELDS[key], value)
+
+    def get(self, key, default=None):
+        field = self._FIELDS.get(key)
+        value = getattr(self, field) if field else None
+        return default if value is None else value
+
+    def to_dict(self) -> dict:
+        return {"role": self.role, "content": self.content}
+
+
+class Conversation:
+    '''
+    单个用户的会话: 历史记录 + 相对默认配置的修改项
+    '''
+    __slots__ = ("sender", "_history", "overrides", "config", "last_active", "nbytes")
+
+    def __init__(self, sender: str, defaults: dict, history=(), overrides: dict = None, last_active: float = None):
+        self.sender = sender
+        self.overrides = overrides or {}
+        # 读取时先查用户修改项再查默认配置, 写入只落在 overrides, 不会改到共享的默认配置
+        self.config = ChainMap(self.overrides, defaults)
+        self.history = history
+        self.last_active = last_active or time.time()
+        self.nbytes = 0
+
+    @property
+    def history(self) -> list:
+        return self._history
+
+    @history.setter
+    def history(self, messages) -> None:
+        self._history = [Message.from_dict(m) for m in messages]
+
+    def append(self, role: str, content: str) -> None:
+        self._history.append(Message(role, content))
+
+    def prompt(self) -> list:
+        return [m.to_dict() for m in self._history]
+
+    def size(self) -> int:
+        return sum(sys.getsizeof(m.content) for m in self._history) + sys.getsizeof(self._history)
+
+
+class ConversationStore:
+    '''
+    会话存储
+    - 内存中按 LRU 保留最近活跃的会话, 数量或字节数超出上限时淘汰
+    - 空闲超过 ttl 的会话同样移出内存
+    - 移出内存的会话写入本地 SQLite, 再次访问或重启后从中恢复
+    '''
+    def __init__(self, defaults: dict, db_path: str = "data/conversations.db", max_users: int = 1000,
+                 max_memory_mb: float = 64, ttl_minutes: float = 60, expire_days: float = 30):
+        self.defaults = defaults
+        self.max_users = max_users
+        self.max_bytes = int(max_memory_mb * 1024 * 1024)
+        self.ttl = ttl_minutes * 60
+        self.expire = expire_days * 86400
+        self.entries = OrderedDict()  # {sender: Conversation}
+        self.total_bytes = 0
+        self.lock = Lock()
+        self.db_lock = Lock()
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS conversations ("
+            "sender TEXT PRIMARY KEY, history TEXT, overrides TEXT, last_active REAL)"
+        )
+        self.db.commit()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, sender: str) -> Conversation:
+        '''
+        获取会话, 不在内存中时从 SQLite 恢复; 不存在时返回 None
+        '''
+        with self.lock:
+            conv = self.entries.get(sender)
+            if conv is not None:
+                self.entries.move_to_end(sender)
+                return conv
+        conv = self._restore(sender)
+        if conv is not None:
+            self.touch(conv)
+        return conv
+
+    def create(self, sender: str, history: list) -> Conversation:
+        conv = Conversation(sender, self.defaults, history)
+        self.touch(conv)
+        return conv
+
+    def touch(self, conv: Conversation) -> None:
+        '''
+        会话有更新: 刷新活跃时间和占用字节数, 超出上限时淘汰最久未活跃的会话
+        '''
+        conv.last_active = time.time()
+        evicted = []
+        with self.lock:
+            old = self.entries.pop(conv.sender, None)
+            if old is not None:
+                self.total_bytes -= old.nbytes
+            conv.nbytes = conv.size()
+            self.entries[conv.sender] = conv
+            self.total_bytes += conv.nbytes
+            while len(self.entries) > 1 and (len(self.entries) > self.max_users or self.total_bytes > self.max_bytes):
+                evicted.append(self._pop(next(iter(self.entries))))
+        self._spill(evicted)
+
+    def _pop(self, sender: str) -> Conversation:
+        conv = self.entries.pop(sender)
+        self.total_bytes -= conv.nbytes
+        return conv
+
+    def evictIdle(self) -> None:
+        '''
+        定时任务: 空闲超过 ttl 的会话写入 SQLite 并移出内存, 清理超过 expire_days 未活跃的记录
+        '''
+        now = time.time()
+        with self.lock:
+            idle = [sender for sender, conv in self.entries.items() if now - conv.last_active > self.ttl]
+            evicted = [self._pop(sender) for sender in idle]
+        self._spill(evicted)
+        if self.expire > 0:
+            with self.db_lock:
+                self.db.execute("DELETE FROM conversations WHERE last_active < ?", (now - self.expire,))
+                self.db.commit()
+        if evicted:
+            LOG.info(f"{len(evicted)} 个空闲会话已写入磁盘, 内存中剩余 {len(self.entries)} 个")
+
+    def flush(self) -> None:
+        '''
+        将内存中的全部会话写入 SQLite(退出前调用), 内存中的会话保留
+        '''
+        with self.lock:
+            convs = list(self.entries.values())
+        self._spill(convs)
+
+    def _spill(self, convs: list) -> None:
+        if not convs:
+            return
+        rows = [
+            (conv.sender,
+             json.dumps([[m.role, m.content] for m in conv.history], ensure_ascii=False),
+             json.dumps(conv.overrides, ensure_ascii=False),
+             conv.last_active)
+            for conv in convs
+        ]
+        try:
+            with self.db_lock:
+                self.db.executemany("INSERT OR REPLACE INTO conversations VALUES (?, ?, ?, ?)", rows)
+                self.db.commit()
+        except sqlite3.Error as e:
+            LOG.error(f"会话写入磁盘出错: {e}")
+
+    def _restore(self, sender: str) -> Conversation:
+        try:
+            with self.db_lock:
+                row = self.db.execute(
+                    "SELECT history, overrides, last_active FROM conversations WHERE sender = ?", (sender,)
+                ).fetchone()
+        except sqlite3.Error as e:
+            LOG.error(f"从磁盘恢复会话出错: {e}")
+            return None
+        if row is None:
+            return None
+        history = [Message(role, content) for role, content in json.loads(row[0])]
+        return Conversation(sender, self.defaults, history, json.loads(row[1]), row[2])
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"users": len(self.entries), "bytes": self.total_bytes}
@@ -0,0 +1,195 @@
+import time
+import logging
+from collections import deque
+from threading import Lock, Timer
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.metrics import metrics
+
+LOG = logging.getLogger("Dispatcher")
+
+
+class MessageDispatcher:
+    '''
+    消息分发器(准入控制)
+    - 同一 key(会话) 的消息串行、按到达顺序处理; 排队中 group 相同的相邻消息合并为一轮处理
+    - 不同 key 的消息在工作线程池中并行处理, 同一 group(群) 同时处理的会话数有上限
+    - 排队过多时立即通知(排队位置/繁忙), 排队过久的消息直接丢弃
+    - key 为 None 的消息(好友请求、系统消息、指令等)进入快速通道, 不会被慢速生成阻塞
+    '''
+    def __init__(self, handler, workers: int = 4, fast_workers: int = 2,
+                 max_queue: int = 200, max_pending_per_key: int = 5,
+                 coalesce_seconds: float = 0.0, merge=None, max_inflight_per_group: int = 0,
+                 notice_threshold: int = 0, stale_seconds: float = 0.0, notify=None):
+        '''
+        Args:
+            coalesce_seconds: 最后一条消息到达后再等待该时间, 让连续发送的后续消息一起合并, 0 表示不等待
+            merge: merge(msgs) -> msg, 合并多条消息; 为空时只保留最后一条
+            max_inflight_per_group: 同一 group 同时处理的会话数上限, 0 表示不限制
+            notice_threshold: 新会话前面排队的会话数达到该值时通知排队位置, 0 表示不通知
+            stale_seconds: 排队超过该时间的消息丢弃, 0 表示不丢弃
+            notify: notify(msg, event, position=None), event: queued | busy | stale
+        '''
+        self.handler = handler
+        self.workers = workers
+        self.max_queue = max_queue
+        self.max_pending_per_key = max_pending_per_key
+        self.coalesce_seconds = coalesce_seconds
+        self.merge = merge or (lambda msgs: msgs[-1])
+        self.max_inflight_per_group = max_inflight_per_group
+        self.notice_threshold = notice_threshold
+        self.stale_seconds = stale_seconds
+        self.notify = notify
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="MsgWorker")
+        self.fast_pool = ThreadPoolExecutor(max_workers=fast_workers, thread_name_prefix="FastWorker")
+        self.pending = {}  # {key: deque([(msg, 到达时间, group), ...])}, key 存在即表示该会话正在被处理或等待处理
+        self.holding = set()  # 等待合并窗口结束的会话, 不占用工作线程
+        self.inflight = {}  # {group: 正在处理的会话数}
+        self.parked = {}  # {group: deque([key, ...])} 因 group 达到上限而等待的会话
+        self.size = 0  # 排队中的消息总数
+        self.running = 0  # 正在处理的会话数
+        self.lock = Lock()
+
+    def _notify(self, msg, event: str, position: int = None) -> None:
+        if self.notify is None:
+            return
+        try:
+            self.notify(msg, event, position)
+        except Exception as e:
+            LOG.error(f"Notify error: {e}")
+
+    def submit(self, key, msg, group=None) -> bool:
+        '''
+        提交消息
+        Args:
+            group: 会话所属分组(如群 id), 用于限制同一群同时处理的会话数
+        Return:
+            是否被接受(队列已满时丢弃)
+        '''
+        if key is None:
+            self.fast_pool.submit(self._handle, msg)
+            return True
+        position = None
+        with self.lock:
+            queue = self.pending.get(key)
+            if self.size >= self.max_queue:
+                LOG.warning(f"消息队列已满({self.size})，丢弃消息: {key}")
+                rejected = True
+            elif queue is not None and len(queue) >= self.max_pending_per_key:
+                LOG.warning(f"{key} 排队消息过多({len(queue)})，丢弃消息")
+                rejected = True
+            else:
+                rejected = False
+                self.size += 1
+                if queue is not None:  # 该会话正在处理或等待中, 排在后面
+                    queue.append((msg, time.time(), group))
+                else:
+                    # 工作线程都被占用时, 前面等待的会话数(不含等待合并窗口的会话)
+                    ahead = len(self.pending) - len(self.holding) - self.workers
+                    if self.notice_threshold and ahead >= self.notice_threshold:
+                        position = ahead
+                    self.pending[key] = deque([(msg, time.time(), group)])
+        if rejected:
+            metrics.inc("messages_dropped_total", reason="busy")
+            self._notify(msg, "busy")
+            return False
+        if position is not None:
+            self._notify(msg, "queued", position)
+        if queue is None:
+            self.pool.submit(self._run, key)
+        return True
+
+    def qsize(self) -> int:
+        return self.size
+
+    def _handle(self, msg) -> None:
+        try:
+            self.handler(msg)
+        except Exception as e:
+            LOG.error(f"Processing message error: {e}")
+
+    def _take(self, key, now: float):
+        '''
+        取出该会话本轮要处理的消息(持有锁时调用)
+        Return:
+            (msgs, 过期消息, 需要等待的时间)
+        '''
+        queue = self.pending[key]
+        stale = []
+        while self.stale_seconds and queue and now - queue[0][1] > self.stale_seconds:
+            stale.append(queue.popleft()[0])
+            self.size -= 1
+        if not queue:
+            return [], stale, None
+        # 已在排队、且来自同一个群(或都是私聊)的相邻消息合并为一轮
+        n = 1
+        while n < len(queue) and queue[n][2] == queue[0][2]:
+            n += 1
+        # 最后一条刚到达, 用户可能还在输入, 稍等再处理
+        if self.coalesce_seconds and n == len(queue) and now - queue[-1][1] < self.coalesce_seconds:
+            return [], stale, queue[-1][1] + self.coalesce_seconds - now
+        return [queue[i][0] for i in range(n)], stale, None
+
+    def _run(self, key) -> None:
+        '''
+        处理该会话的一轮消息, 若还有排队消息则重新提交, 让其他会话也能轮到
+        '''
+        with self.lock:
+            now = time.time()
+            self.holding.discard(key)
+            msgs, stale, delay = self._take(key, now)
+            group = self.pending[key][0][2] if msgs else None
+            if delay is not None:
+                self.holding.add(key)
+            elif not msgs:  # 全部过期
+                del self.pending[key]
+            elif msgs and group is not None and self.max_inflight_per_group \
+                    and self.inflight.get(group, 0) >= self.max_inflight_per_group:
+                self.parked.setdefault(group, deque()).append(key)
+                msgs = []
+            elif msgs:
+                self.running += 1
+                if group is not None:
+                    self.inflight[group] = self.inflight.get(group, 0) + 1
+                waits = [now - arrival for _, arrival, _ in list(self.pending[key])[:len(msgs)]]
+        for msg in stale:
+            LOG.warning(f"{key} 的消息排队过久，丢弃")
+            metrics.inc("messages_dropped_total", reason="stale")
+            self._notify(msg, "stale")
+        if delay is not None:
+            Timer(delay, self.pool.submit, (self._run, key)).start()
+            return
+        if not msgs:
+            return
+        for queue_wait in waits:
+            metrics.observe("stage_seconds", queue_wait, stage="queue_wait")
+        if len(msgs) > 1:
+            metrics.inc("messages_coalesced_total", len(msgs) - 1)
+        with metrics.stage("handle"):
+            self._handle(self.merge(msgs) if len(msgs) > 1 else msgs[0])
+        resubmit = []
+        with self.lock:
+            self.running -= 1
+            if group is not None:
+                self.inflight[group] -= 1
+                parked = self.parked.get(group)
+                if parked:
+                    resubmit.append(parked.popleft())
+                if not self.inflight[group]:
+                    del self.inflight[group]
+                if parked is not None and not parked:
+                    del self.parked[group]
+            queue = self.pending[key]
+            for _ in msgs:
+                queue.popleft()
+            self.size -= len(msgs)
+            if queue:
+                resubmit.append(key)
+            else:
+                del self.pending[key]
+        for next_key in resubmit:
+            self.pool.submit(self._run, next_key)
+
+    def shutdown(self, wait: bool = True) -> None:
+        self.pool.shutdown(wait=wait)
+        self.fast_pool.shutdown(wait=wait)
@@ -0,0 +1,182 @@
+import os
+import json
+import time
+import logging
+from bisect import bisect_left
+from threading import Lock, Thread
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LOG = logging.getLogger("Metrics")
+
+# 耗时直方图的桶上界(s), 覆盖从检索的毫秒级到生成的分钟级
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _labels_text(labels: tuple, extra: str = "") -> str:
+    parts = [f'{key}="{value}"' for key, value in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Metrics:
+    '''
+    进程内的直方图 & 计数器 & 瞬时值
+    - observe/inc/set 可在任意线程中调用
+    - render() 输出 Prometheus 文本格式, snapshot() 输出可 json 序列化的字典
+    '''
+    def __init__(self, prefix: str = "wechatbot", buckets: tuple = DEFAULT_BUCKETS):
+        self.prefix = prefix
+        self.buckets = tuple(buckets)
+        self.histograms = {}  # {(name, labels): [各桶计数..., +Inf 计数]}, labels: ((key, value), ...)
+        self.sums = {}  # {(name, labels): 总和}
+        self.counters = {}  # {(name, labels): 值}
+        self.gauges = {}  # {(name, labels): 当前值}
+        self.lock = Lock()
+        self.server = None
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        pos = bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.histograms.get(key)
+            if counts is None:
+                counts = self.histograms[key] = [0] * (len(self.buckets) + 1)
+                self.sums[key] = 0.0
+            counts[pos] += 1
+            self.sums[key] += value
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def stage(self, stage: str):
+        '''
+        记录消息处理某一阶段的耗时: with metrics.stage("embedding"): ...
+        '''
+        return self.timer("stage_seconds", stage=stage)
+
+    def render(self) -> str:
+        with self.lock:
+            histograms = {key: list(counts) for key, counts in self.histograms.items()}
+            sums = dict(self.sums)
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+        lines = []
+        for name in sorted(set(key[0] for key in histograms)):
+            metric = f"{self.prefix}_{name}"
+            lines.append(f"# TYPE {metric} histogram")
+            for key in sorted(k for k in histograms if k[0] == name):
+                counts, labels = histograms[key], key[1]
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += count
+                    le = 'le="%s"' % bound
+                    lines.append(f"{metric}_bucket{_labels_text(labels, le)} {cumulative}")
+                lines.append(f"{metric}_sum{_labels_text(labels)} {sums[key]}")
+                lines.append(f"{metric}_count{_labels_text(labels)} {cumulative}")
+        for name in sorted(set(key[0] for key in counters)):
+            metric = f"{self.prefix}_{name}"
+            lines.append(f"# TYPE {metric} counter")
+            for key in sorted(k for k in counters if k[0] == name):
+                lines.append(f"{metric}{_labels_text(key[1])} {counters[key]}")
+        for name in sorted(set(key[0] for key in gauges)):
+            metric = f"{self.prefix}_{name}"
+            lines.append(f"# TYPE {metric} gauge")
+            for key in sorted(k for k in gauges if k[0] == name):
+                lines.append(f"{metric}{_labels_text(key[1])} {gauges[key]}")
+        return "\n".join(lines) + "\n"
+
+    def _quantile(self, counts: list, q: float) -> float:
+        '''
+        由直方图估计分位数(取所在桶的上界), 超出最大的桶时返回 None
+        '''
+        total = sum(counts)
+        if total == 0:
+            return 0.0
+        rank, cumulative = q * total, 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return None
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            histograms = {key: list(counts) for key, counts in self.histograms.items()}
+            sums = dict(self.sums)
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+        result = {"time": time.time(), "histograms": {}, "counters": {}, "gauges": {}}
+        for key, counts in sorted(histograms.items()):
+            count = sum(counts)
+            result["histograms"][f"{key[0]}{_labels_text(key[1])}"] = {
+                "count": count,
+                "avg": sums[key] / count if count else 0.0,
+                "p50": self._quantile(counts, 0.5),
+                "p95": self._quantile(counts, 0.95),
+                "p99": self._quantile(counts, 0.99),
+            }
+        for key, value in sorted(counters.items()):
+            result["counters"][f"{key[0]}{_labels_text(key[1])}"] = value
+        for key, value in sorted(gauges.items()):
+            result["gauges"][f"{key[0]}{_labels_text(key[1])}"] = value
+        return result
+
+    def dump(self, path: str) -> None:
+        '''
+        将当前快照写入 json 文件(先写临时文件再替换)
+        '''
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", 'w', encoding='utf-8') as fout:
+            json.dump(self.snapshot(), fout, ensure_ascii=False, indent=2)
+        os.replace(path + ".tmp", path)
+
+    def serve(self, host: str = "127.0.0.1", port: int = 9108) -> None:
+        '''
+        在后台线程中启动 HTTP 服务: /metrics 为 Prometheus 文本格式, /metrics.json 为 json 快照
+        '''
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body, content_type = metrics.render().encode('utf-8'), "text/plain; version=0.0.4; charset=utf-8"
+                elif self.path == "/metrics.json":
+                    body, content_type = json.dumps(metrics.snapshot(), ensure_ascii=False).encode('utf-8'), "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        Thread(target=self.server.serve_forever, name="Metrics", daemon=True).start()
+        LOG.info(f"metrics 服务: http://{host}:{port}/metrics")
+
+
+# 进程内共享的指标
+metrics = Metrics()
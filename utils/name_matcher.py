@@ -0,0 +1,148 @@
+import os
+from threading import Lock
+from collections import deque
+
+PRE_INFO_DIR = "pre_info"
+
+
+def _is_word_char(ch: str) -> bool:
+    # 只有 ASCII 字母数字需要词边界, 中文等字符前后可以直接相连
+    return ch.isascii() and ch.isalnum()
+
+
+class _Automaton:
+    '''
+    Aho-Corasick 自动机(构建后只读, 可多线程共享)
+    '''
+    def __init__(self, names):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]  # 每个节点命中的 [(name, length), ...]
+        for name in names:
+            self._insert(name)
+        self._build()
+
+    def _insert(self, name: str) -> None:
+        node = 0
+        key = name.lower()
+        for ch in key:
+            nxt = self.goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[node][ch] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append([])
+            node = nxt
+        self.out[node].append((name, len(key)))
+
+    def _build(self) -> None:
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self.goto[node].items():
+                f = self.fail[node]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0)
+                self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]]
+                queue.append(nxt)
+
+    def findall(self, text: str) -> list:
+        '''
+        Return:
+            [(start, end, name), ...] 位置基于 text.lower()
+        '''
+        matches = []
+        node = 0
+        for i, ch in enumerate(text):
+            while node and ch not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(ch, 0)
+            for name, length in self.out[node]:
+                matches.append((i + 1 - length, i + 1, name))
+        return matches
+
+
+class NameMatcher:
+    '''
+    从 pre_info 目录构建的人名匹配器
+    - 一次线性扫描找出文本中所有人名(忽略大小写)
+    - ASCII 人名要求前后不是字母数字, 中文人名可与前后文字相连
+    - pre_info 目录有增删时自动重建
+    '''
+    def __init__(self, names=None, pre_info_dir: str = PRE_INFO_DIR):
+        self.pre_info_dir = pre_info_dir if names is None else None
+        self.lock = Lock()
+        self._mtime = None
+        self.names = set()
+        if names is not None:
+            self.names = set(names)
+            self._automaton = _Automaton(self.names)
+        else:
+            self._automaton = _Automaton(())
+            self.refresh()
+
+    def refresh(self) -> bool:
+        '''
+        目录修改时间变化时重新扫描, 只在人名集合有增删时重建自动机
+        Return:
+            是否重建
+        '''
+        if self.pre_info_dir is None:
+            return False
+        try:
+            mtime = os.stat(self.pre_info_dir).st_mtime_ns
+        except FileNotFoundError:
+            return False
+        if mtime == self._mtime:
+            return False
+        with self.lock:
+            if mtime == self._mtime:
+                return False
+            names = set(file.split('.')[0] for file in os.listdir(self.pre_info_dir))
+            self._mtime = mtime
+            if names == self.names:
+                return False
+            self._automaton = _Automaton(names)  # 整体替换, 匹配中的线程仍使用旧自动机
+            self.names = names
+        return True
+
+    def match(self, text: str) -> list:
+        '''
+        提取文本中出现的人名, 按出现顺序去重, 返回 pre_info 中的原始名称
+        重叠时取最左、最长的匹配
+        '''
+        lowered = text.lower()
+        if len(lowered) != len(text):  # 个别字符小写后长度变化, 边界判断退化为使用小写文本
+            text = lowered
+        matches = self._automaton.findall(lowered)
+        matches.sort(key=lambda m: (m[0], m[0] - m[1]))
+        result, seen, pos = [], set(), 0
+        for start, end, name in matches:
+            if start < pos:
+                continue
+            if _is_word_char(text[start]) and start > 0 and _is_word_char(text[start - 1]):
+                continue
+            if _is_word_char(text[end - 1]) and end < len(text) and _is_word_char(text[end]):
+                continue
+            pos = end
+            if name not in seen:
+                seen.add(name)
+                result.append(name)
+        return result
+
+
+_default_matcher = None
+
+
+def get_name_matcher() -> NameMatcher:
+    '''
+    默认的 pre_info 人名匹配器(懒加载, 每次获取时检查目录是否有变化)
+    '''
+    global _default_matcher
+    if _default_matcher is None:
+        _default_matcher = NameMatcher()
+    else:
+        _default_matcher.refresh()
+    return _default_matcher
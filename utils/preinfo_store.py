@@ -0,0 +1,107 @@
+import os
+import logging
+from threading import Lock
+from collections import OrderedDict
+
+from utils.metrics import metrics
+
+PRE_INFO_DIR = "pre_info"
+LOG = logging.getLogger("PreInfoStore")
+
+
+class PreInfoStore:
+    '''
+    pre_info 文档内存缓存
+    - 热点文档常驻内存, 总字节数超出预算时按 LRU 淘汰
+    - 每次读取检查 mtime/size, 文件被修改后无需重启即可生效
+    - 命中/未命中/淘汰次数及缓存大小导出到 metrics
+    '''
+    def __init__(self, root: str = PRE_INFO_DIR, max_bytes: int = 64 * 1024 * 1024):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # {name: (mtime_ns, size, content)}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = Lock()
+
+    def _read(self, path: str) -> str:
+        # 整个文档都要解码并缓存, 直接一次读入
+        with open(path, 'rb') as fin:
+            data = fin.read()
+        # 与文本模式读取一致, 统一换行符
+        return data.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+
+    def get(self, name: str) -> str:
+        '''
+        读取 pre_info/<name>.txt, 文件不存在时返回空字符串
+        '''
+        path = os.path.join(self.root, f"{name}.txt")
+        try:
+            stat = os.stat(path)
+        except OSError:
+            with self.lock:
+                self._pop(name)
+                self._export()
+            return ""
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is not None and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size:
+                self.entries.move_to_end(name)
+                self.hits += 1
+                metrics.inc("preinfo_cache_total", result="hit")
+                return entry[2]
+            self.misses += 1
+        metrics.inc("preinfo_cache_total", result="miss")
+        try:
+            content = self._read(path)
+        except (OSError, ValueError) as e:
+            LOG.error(f"读取 {path} 出错: {e}")
+            return ""
+        with self.lock:
+            self._pop(name)
+            if stat.st_size <= self.max_bytes:
+                self.entries[name] = (stat.st_mtime_ns, stat.st_size, content)
+                self.total_bytes += stat.st_size
+                while self.total_bytes > self.max_bytes:
+                    self._pop(next(iter(self.entries)))
+                    self.evictions += 1
+                    metrics.inc("preinfo_evictions_total")
+            self._export()
+        return content
+
+    def load(self, names) -> str:
+        '''
+        拼接多个文档, 每个文档后接一个换行
+        '''
+        return "".join([f"{self.get(name)}\n" for name in names])
+
+    def _pop(self, name: str) -> None:
+        entry = self.entries.pop(name, None)
+        if entry is not None:
+            self.total_bytes -= entry[1]
+
+    def _export(self) -> None:
+        metrics.set("preinfo_cache_bytes", self.total_bytes)
+        metrics.set("preinfo_cache_entries", len(self.entries))
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+            }
+
+
+_default_store = None
+
+
+def get_preinfo_store() -> PreInfoStore:
+    global _default_store
+    if _default_store is None:
+        _default_store = PreInfoStore()
+    return _default_store
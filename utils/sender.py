@@ -0,0 +1,230 @@
+import time
+import logging
+from threading import Thread, Condition
+from collections import OrderedDict, deque
+
+from utils.metrics import metrics
+
+LOG = logging.getLogger("Sender")
+
+
+class TokenBucket:
+    '''
+    令牌桶: 平均每秒 rate 个, 最多积攒 burst 个
+    '''
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        '''
+        距离下一个令牌可用还需等待的时间(s), 0 表示可以立即发送
+        '''
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+
+def split_text(text: str, max_chars: int) -> list:
+    '''
+    长消息按段落切分, 单段过长时按行切分, 单行仍过长时按长度截断; 每片不超过 max_chars
+    '''
+    if len(text) <= max_chars:
+        return [text]
+    pieces = []
+    current = ""
+    for paragraph in text.split("\n\n"):
+        units = [paragraph] if len(paragraph) <= max_chars else paragraph.split("\n")
+        for i, unit in enumerate(units):
+            sep = "\n\n" if i == 0 else "\n"
+            while len(unit) > max_chars:
+                if current:
+                    pieces.append(current)
+                    current = ""
+                pieces.append(unit[:max_chars])
+                unit = unit[max_chars:]
+            if current and len(current) + len(sep) + len(unit) > max_chars:
+                pieces.append(current)
+                current = ""
+            current = f"{current}{sep}{unit}" if current else unit
+    if current:
+        pieces.append(current)
+    return [piece for piece in pieces if piece.strip()]
+
+
+class _Outgoing:
+    __slots__ = ("text", "receiver", "at_list", "enqueued")
+
+    def __init__(self, text: str, receiver: str, at_list: str):
+        self.text = text
+        self.receiver = receiver
+        self.at_list = at_list
+        self.enqueued = time.monotonic()
+
+
+class OutboundSender:
+    '''
+    异步发送队列, 在独立线程中调用 send_func, 生成线程不会被发送阻塞
+    - 每个接收方、以及全局各一个令牌桶限速, 不同接收方之间轮流发送
+    - 超长消息按段落切分; 同一接收方排队中的短消息合并为一条发送
+    - 统计排队延迟
+    '''
+    def __init__(self, send_func, receiver_rate: float = 1.0, receiver_burst: int = 3,
+                 global_rate: float = 5.0, global_burst: int = 10, max_chars: int = 1500,
+                 max_queue: int = 1000, latency_window: int = 1000):
+        '''
+        Args:
+            send_func: send_func(text, receiver, at_list), 实际发送消息
+        '''
+        self.send_func = send_func
+        self.receiver_rate = receiver_rate
+        self.receiver_burst = receiver_burst
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.max_chars = max_chars
+        self.max_queue = max_queue
+        self.queues = OrderedDict()  # {receiver: deque[_Outgoing]}, 顺序即轮转顺序
+        self.buckets = {}  # {receiver: TokenBucket}
+        self.pending = 0
+        self.sent = 0
+        self.merged = 0
+        self.dropped = 0
+        self.failed = 0
+        self.latencies = deque(maxlen=latency_window)  # 最近发送消息的排队延迟(s)
+        self.cond = Condition()
+        self.running = False
+        self.thread = None
+
+    def start(self) -> None:
+        self.running = True
+        self.thread = Thread(target=self._loop, name="Sender", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        '''
+        等待队列发送完毕(最多 timeout 秒)后停止
+        '''
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while self.pending and time.monotonic() < deadline:
+                self.cond.wait(0.1)
+            self.running = False
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def send(self, text: str, receiver: str, at_list: str = "") -> bool:
+        '''
+        加入发送队列
+        Return:
+            False 表示队列已满被丢弃
+        '''
+        pieces = split_text(text, self.max_chars)
+        with self.cond:
+            if self.pending + len(pieces) > self.max_queue:
+                self.dropped += len(pieces)
+                LOG.error(f"发送队列已满({self.pending}), 丢弃发给 {receiver} 的消息")
+                return False
+            queue = self.queues.get(receiver)
+            if queue is None:
+                queue = self.queues[receiver] = deque()
+            for i, piece in enumerate(pieces):
+                queue.append(_Outgoing(piece, receiver, at_list if i == 0 else ""))  # 只在第一片 @
+            self.pending += len(pieces)
+            self.cond.notify()
+        return True
+
+    def _merge(self, queue: deque) -> _Outgoing:
+        '''
+        取出队首消息, 并把紧随其后的短消息合并进来; 带 @ 的消息只与 @ 同一人的消息合并
+        '''
+        item = queue.popleft()
+        while queue:
+            nxt = queue[0]
+            if nxt.at_list not in ("", item.at_list) or len(item.text) + 1 + len(nxt.text) > self.max_chars:
+                break
+            queue.popleft()
+            item.text = f"{item.text}\n{nxt.text}"
+            self.latencies.append(time.monotonic() - nxt.enqueued)
+            metrics.observe("stage_seconds", self.latencies[-1], stage="send_queue")
+            self.pending -= 1
+            self.merged += 1
+        return item
+
+    def _next(self):
+        '''
+        Return:
+            (待发送消息, None) 或 (None, 需要等待的时间)
+        '''
+        now = time.monotonic()
+        wait = self.global_bucket.wait_time(now)
+        if wait > 0:
+            return None, wait
+        wait = None
+        for receiver in list(self.queues):
+            bucket = self.buckets.get(receiver)
+            if bucket is None:
+                bucket = self.buckets[receiver] = TokenBucket(self.receiver_rate, self.receiver_burst)
+            receiver_wait = bucket.wait_time(now)
+            if receiver_wait > 0:
+                wait = receiver_wait if wait is None else min(wait, receiver_wait)
+                continue
+            queue = self.queues.pop(receiver)
+            item = self._merge(queue)
+            if queue:
+                self.queues[receiver] = queue  # 还有消息, 排到轮转末尾
+            bucket.take()
+            self.global_bucket.take()
+            self.pending -= 1
+            return item, None
+        return None, wait
+
+    def _loop(self) -> None:
+        while True:
+            with self.cond:
+                item, wait = None, None
+                while self.running:
+                    item, wait = self._next()
+                    if item is not None:
+                        break
+                    self.cond.wait(wait)
+                if item is None:
+                    return
+                self.latencies.append(time.monotonic() - item.enqueued)
+                self.cond.notify_all()
+            metrics.observe("stage_seconds", self.latencies[-1], stage="send_queue")
+            try:
+                with metrics.stage("send"):
+                    self.send_func(item.text, item.receiver, item.at_list)
+                self.sent += 1
+            except Exception as e:
+                self.failed += 1
+                metrics.inc("send_failed_total")
+                LOG.error(f"发送消息给 {item.receiver} 出错: {e}")
+
+    def stats(self) -> dict:
+        with self.cond:
+            latencies = sorted(self.latencies)
+            pending, receivers = self.pending, len(self.queues)
+
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))] if latencies else 0.0
+
+        return {
+            "pending": pending,
+            "receivers": receivers,
+            "sent": self.sent,
+            "merged": self.merged,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "latency_p50": percentile(0.5),
+            "latency_p95": percentile(0.95),
+            "latency_max": latencies[-1] if latencies else 0.0,
+        }
@@ -0,0 +1,60 @@
+import time
+import logging
+from threading import Lock, current_thread
+from contextlib import contextmanager
+
+LOG = logging.getLogger("Startup")
+
+
+class StartupProfiler:
+    '''
+    记录启动各阶段耗时(可在多个线程中并行记录)
+    '''
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = []  # [(name, begin, end, thread, error), ...] 时间相对 start
+        self.lock = Lock()
+
+    @contextmanager
+    def phase(self, name: str):
+        begin = time.perf_counter() - self.start
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            end = time.perf_counter() - self.start
+            with self.lock:
+                self.phases.append((name, begin, end, current_thread().name, error))
+
+    def run(self, name: str, func, *args, **kwargs):
+        '''
+        在计时阶段中执行 func, 出错时记录日志并返回 None
+        '''
+        try:
+            with self.phase(name):
+                return func(*args, **kwargs)
+        except Exception as e:
+            LOG.error(f"启动阶段 {name} 出错: {e}")
+            return None
+
+    def mark(self, name: str) -> None:
+        '''
+        记录一个时间点(如开始接收消息)
+        '''
+        now = time.perf_counter() - self.start
+        with self.lock:
+            self.phases.append((name, now, now, current_thread().name, None))
+
+    def report(self) -> str:
+        with self.lock:
+            phases = sorted(self.phases, key=lambda p: p[1])
+        total = max((p[2] for p in phases), default=0.0)
+        lines = [f"{'阶段':<24}{'开始(s)':>10}{'结束(s)':>10}{'耗时(s)':>10}  线程"]
+        for name, begin, end, thread, error in phases:
+            status = f"  出错: {error}" if error is not None else ""
+            lines.append(f"{name:<24}{begin:>10.2f}{end:>10.2f}{end - begin:>10.2f}  {thread}{status}")
+        lines.append(f"总耗时: {total:.2f}s")
+        return "\n".join(lines)
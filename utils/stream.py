@@ -0,0 +1,82 @@
+import re
+
+THINK_BEGIN = "<think>"
+THINK_END = "</think>"
+# 句子结束符(中英文)
+_SENTENCE_END = re.compile(r"[。！？!?；;…\n]")
+
+
+class StreamSegmenter:
+    '''
+    流式输出分段
+    - 把模型逐步生成的文本切分为完整的段落/句子, 便于边生成边发送
+    - mask_think=True 时实时屏蔽 <think>...</think> 部分
+    '''
+    def __init__(self, mask_think: bool = True, min_chars: int = 30, thinking: bool = False):
+        '''
+        Args:
+            thinking: prompt 是否已打开 <think>, 否则只有以 <think> 开头的输出含思考部分
+        '''
+        self.mask_think = mask_think
+        self.min_chars = min_chars  # 句子达到该长度才单独发送, 段落(空行)总是立即发送
+        self.in_think = mask_think and thinking
+        self.pending = mask_think and not thinking  # 还不能确定输出是否以 <think> 开头
+        self.think_buffer = ""
+        self.buffer = ""
+
+    def feed(self, text: str) -> list:
+        '''
+        输入新生成的文本, 返回已完成的片段
+        '''
+        if self.pending:
+            self.think_buffer += text
+            head = self.think_buffer.lstrip()
+            if THINK_BEGIN.startswith(head):  # 可能是被拆开的 <think>
+                return []
+            self.pending = False
+            self.in_think = head.startswith(THINK_BEGIN)
+            text, self.think_buffer = self.think_buffer, ""
+        if self.in_think:
+            self.think_buffer += text
+            end = self.think_buffer.find(THINK_END)
+            if end == -1:
+                return []
+            self.in_think = False
+            text = self.think_buffer[end + len(THINK_END):]
+            self.think_buffer = ""
+        self.buffer += text
+        return self._split()
+
+    def flush(self) -> list:
+        '''
+        生成结束, 返回剩余内容
+        '''
+        if self.pending:
+            self.buffer += self.think_buffer
+        # 否则没有出现 </think> 说明思考被截断, 丢弃思考部分
+        self.think_buffer = ""
+        self.pending = self.in_think = False
+        rest = self.buffer.strip()
+        self.buffer = ""
+        return [rest] if rest else []
+
+    def _split(self) -> list:
+        segments = []
+        while True:
+            # 优先按段落切分
+            pos = self.buffer.find("\n\n")
+            if pos != -1:
+                cut = pos + 2
+            else:
+                cut = -1
+                for match in _SENTENCE_END.finditer(self.buffer):
+                    if match.end() >= self.min_chars:
+                        cut = match.end()
+                        break
+                if cut == -1:
+                    break
+            segment = self.buffer[:cut].strip()
+            self.buffer = self.buffer[cut:]
+            if segment:
+                segments.append(segment)
+        return segments
@@ -1,7 +1,7 @@
-import os
-import re
 import yaml
 import jieba
+from utils.name_matcher import NameMatcher, get_name_matcher
+from utils.preinfo_store import get_preinfo_store
 
 STOPWORDS_PATH = "configs/stopwords.txt"
 
@@ -39,42 +39,52 @@ def remove_stopwords(text, stopwords: set=None):
 def extract_name(text, name_set=None):
     """
     提取文本中包含在集合内的关键词
+    name_set 为空时使用 pre_info 目录构建的匹配器(只构建一次, 目录有增删时自动重建)
     """
-    if name_set is None:
-        name_list = os.listdir("pre_info")
-        name_set = set([file.split('.')[0] for file in name_list])
-        # print(f"name set: {name_set}")
-    # 转义特殊字符并构建正则模式
-    escaped = [re.escape(abbr) for abbr in name_set]
-    pattern = r'\b(' + '|'.join(escaped) + r')\b'
-    # 忽略大小写，确保匹配所有变体
-    regex = re.compile(pattern, flags=re.IGNORECASE)
-    # 提取所有匹配项
-    matches = regex.findall(text)
-    # 去重并统一为小写（若需保留原格式，移除 lower()）
-    seen = set()
-    result = []
-    for match in matches:
-        lower_match = match.lower()
-        if lower_match not in seen:
-            seen.add(lower_match)
-            result.append(lower_match)
-    return result
+    matcher = get_name_matcher() if name_set is None else NameMatcher(name_set)
+    return matcher.match(text)
 
 def text_to_vector(model, text):
     # model = SentenceTransformer('sbert-base-chinese-nli')
     return model.encode(text)
 
 def load_search_file(file_name):
-    try:
-        with open(f"pre_info/{file_name}.txt", 'r', encoding='utf-8') as fin:
-            pre_info = fin.read()
-        return pre_info
-    except:
-        return ""
+    return get_preinfo_store().get(file_name)
 
 def load_preinfo(file_names):
-    res = ""
-    for name in file_names:
-        res = res + load_search_file(name) + "\n"
-    return res
\ No newline at end of file
+    return get_preinfo_store().load(file_names)
+
+def estimate_tokens(text):
+    '''
+    粗略估计 token 数: 中文约 1 字 1 token, 其他字符约 4 字符 1 token
+    '''
+    cjk = sum(1 for ch in text if '\u4e00' <= ch <= '\u9fff')
+    return cjk + (len(text) - cjk + 3) // 4
+
+def load_passages(chunks, max_tokens=1024, seen=""):
+    '''
+    按检索顺序选取片段, 总长度不超过 token 预算; 同一文件中重叠/相邻的片段合并后按原文顺序输出
+    Args:
+        chunks: [(filename, start, end, distance), ...]
+        seen: 对话中已有的文本, 原文已出现在其中的片段不再重复加入
+    '''
+    store = get_preinfo_store()
+    selected, used = [], 0
+    for name, start, end, _ in chunks:
+        text = store.get(name)[start:end].strip()
+        tokens = estimate_tokens(text)
+        if tokens == 0 or used + tokens > max_tokens or text in seen:
+            continue
+        selected.append((name, start, end))
+        used += tokens
+    merged = {}  # 按文件首次被选中的顺序
+    for name, _, _ in selected:
+        merged.setdefault(name, [])
+    for name, start, end in sorted(selected):
+        spans = merged[name]
+        if spans and start <= spans[-1][1]:
+            spans[-1][1] = max(spans[-1][1], end)
+        else:
+            spans.append([start, end])
+    parts = [store.get(name)[start:end].strip() for name, spans in merged.items() for start, end in spans]
+    return "".join([f"{part}\n" for part in dict.fromkeys(parts)])  # 不同文件中内容相同的片段只保留一份